@@ -159,7 +159,9 @@ class Command(pragma.commands.Command):
 		if not(driver.allocate(num_cpus, memory, key, add_ifaces, repository)):
 		   self.abort("Unable to allocate virtual cluster, please check log")
 		# start cluster
-		driver.deploy(repository)
+		if not driver.deploy(repository):
+			repository.clean()
+			self.abort("Unable to deploy virtual cluster, please check log")
 
 		# cleanup
 		repository.clean() 
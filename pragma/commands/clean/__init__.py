@@ -9,17 +9,51 @@ class Command(pragma.commands.Command):
 	Unallocates virtual cluster and removes its disk images
 
 	<arg type='string' name='vc-name'>
-	The name of the cluster which should be remvoed.
+	The name of the cluster which should be remvoed. Optional with
+	cache=true, where all cached images that are not pinned are removed
+	if it is not given.
 	</arg>
 
+	<param type='boolean' name='cache'>
+	Remove cached virtual cluster images from the local repository
+	instead of a virtual cluster. The virtual cluster descriptions are
+	kept and the images are downloaded again from the remote repository
+	the next time they are booted. Virtual clusters listed in
+	cache_pinned are kept unless named. (default: false)
+	</param>
+
+	<param type='string' name='loglevel'>
+	Specify level of log messages (default: INFO)
+	</param>
+
 	<example cmd='clean myPragmaCluster'>
 	Will remove the virtual cluster named myPragmaCluster.
 	</example>
+
+	<example cmd='clean cache=true'>
+	Will remove all cached images that are not pinned.
+	</example>
+
+	<example cmd='clean cache=true centos7'>
+	Will remove the cached images of the centos7 virtual image.
+	</example>
 	"""
 
 	def run(self, params, args):
 
 		(args, vcname) = self.fillPositionalArgs(('vc-name'))
+		(cache, loglevel) = self.fillParams([('cache', 'false'), ('loglevel', 'INFO')])
+
+		if pragma.utils.str2bool(cache):
+			self.config_logging(loglevel)
+			repository = self.getRepository()
+			if vcname:
+				print "Removing cached images of %s" % vcname
+				repository.delete_vc(vcname)
+			else:
+				print "Removing all cached images"
+				repository.clear_cache()
+			return
 
 		if not vcname:
 			self.abort('must supply a name for the virtual cluster')
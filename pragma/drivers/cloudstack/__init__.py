@@ -96,7 +96,7 @@ class Driver(pragma.drivers.Driver):
 		Deploy the specified virtual cluster
 
 		:param repository: repository with xml in/out objects
-		:return:
+		:return: True if all nodes were started, otherwise False
 		"""
 		vc_in = repository.getXmlInputObject(repository.cluster)
 		temp_dir = repository.getStagingDir()
@@ -117,7 +117,7 @@ class Driver(pragma.drivers.Driver):
 				self.logger.error("Unable to deploy compute %s" % name)
 				return False
 			self.logger.info("Successfully deployed compute %s" % name)
-
+		return True
 
 	def initializeAndStartVM(self, name, vc_out):
 		updates = {"userdata": base64.b64encode(str(vc_out))}
@@ -1,7 +1,8 @@
 import logging
 import pragma
 import pragma.utils
-from pragma.drivers.kvm_rocks.image_manager import ImageManager
+from pragma.drivers.kvm_rocks.customizer import GuestfsSession
+from pragma.drivers.kvm_rocks.image_manager import ImageManager, ZfsImageManager
 import math
 import os
 import re
@@ -12,6 +13,8 @@ import time
 
 
 class Driver(pragma.drivers.Driver):
+	BOOT_ACTION_TIMEOUT = 60
+
 	def __init__(self, basepath):
 		pragma.drivers.Driver.__init__(self, basepath)
 		self.setModuleVals()
@@ -202,20 +205,42 @@ class Driver(pragma.drivers.Driver):
 		Boot the specified Rocks node
 
 		:param node: Name of Rocks node
-		:return:
+		:return: True if the node was started, otherwise False
 		"""
 		(out, exitcode) = pragma.utils.getRocksOutputAsList(
 			"set host boot %s action=os" % node )
 		if exitcode != 0:
 			self.logger.error("Error setting boot on %s: %s" % (
 				node, "\n".join(out)))
-			return
-		time.sleep(15)
+			return False
+		if self.wait_for_boot_action(node, "os") is None:
+			return False
 		(out, exitcode) = pragma.utils.getRocksOutputAsList(
 			"start host vm %s" % node)
 		if exitcode != 0:
 			self.logger.error("Problem booting %s: %s" % (
 				node, "\n".join(out)))
+			return False
+		return True
+
+	def wait_for_boot_action(self, node, action):
+		"""
+		Wait until the Rocks db reports the boot action of the specified node
+
+		:param node: Name of Rocks node
+		:param action: Boot action that was set
+		:return: Number of secs waited or None if timed out
+		"""
+		action_pat = re.compile("^%s:\s+%s(\s|$)" % (re.escape(node), action))
+
+		def action_set():
+			(out, exitcode) = pragma.utils.getRocksOutputAsList(
+				"list host boot %s" % node)
+			return exitcode == 0 and any(
+				action_pat.search(line) for line in out)
+
+		return pragma.utils.wait_until(action_set, self.BOOT_ACTION_TIMEOUT,
+			"boot action %s of %s" % (action, node))
 
 	def calculate_num_nodes(self, cpus_requested, available_containers, num_processors_reserved):
 		"""
@@ -303,8 +328,38 @@ class Driver(pragma.drivers.Driver):
 		Deploy the specified virtual cluster
 
 		:param repository: repository with xml in/out objects
-		:return:
+		:return: True if all nodes were booted, otherwise False
 		"""
+		# number of compute node batches prepared and booted at the same time,
+		# number of compute images customized by one libguestfs appliance and
+		# whether computes are configured with a config disk, whose image is
+		# sent to the containers through distribution_chains chains
+		execfile(self.driverconf, {}, globals())
+		concurrency = 1
+		try:
+			concurrency = max(1, int(deploy_concurrency))
+		except:
+			pass
+		batch_size = 4
+		try:
+			batch_size = max(1, int(customize_batch))
+		except:
+			pass
+		if not GuestfsSession.available():
+			# guestmount customizes one image at a time, batches would only
+			# keep more image copies in the staging directory
+			batch_size = 1
+		config_disk = False
+		try:
+			config_disk = bool(compute_config_disk)
+		except:
+			pass
+		chains = 1
+		try:
+			chains = max(1, int(distribution_chains))
+		except:
+			pass
+
 		# get references to xml in/out objects and temp directory 
 		vc_in = repository.getXmlInputObject(repository.cluster)
 		vc_out = repository.getXmlOutputObject()
@@ -318,19 +373,60 @@ class Driver(pragma.drivers.Driver):
 			vc_out.filename: "/root/vc-out.xml"
 		}
 		image_manager = ImageManager.factory(vc_in, vc_out, temp_dir)
+		if config_disk and isinstance(image_manager, ZfsImageManager):
+			self.logger.warning("compute_config_disk is not supported with ZFS volumes, ignoring it")
+			config_disk = False
+		image_manager.config_disk = config_disk
+		image_manager.distribution_chains = chains
 
 		# prepare and boot frontend
-		image_manager.prepare_frontend(network_conf, new_config)
-		self.boot(image_manager.fe_name)
-
-		# prepare and boot computes
-		for node in vc_out.get_compute_names():
-			compute_config = {
-				vc_out.get_vc_out(node): "/root/vc-out.xml"
-			}
-			image_manager.prepare_compute(node, network_conf, compute_config)
-			self.boot(node)
+		if not image_manager.prepare_frontend(network_conf, new_config):
+			self.logger.error("Unable to prepare frontend %s" % image_manager.fe_name)
+			image_manager.boot_cleanup()
+			return False
+		if not self.boot(image_manager.fe_name):
+			self.logger.error("Unable to boot frontend %s" % image_manager.fe_name)
+			image_manager.boot_cleanup()
+			return False
+
+		# prepare and boot computes in batches, each node with its own copy
+		# of the image so a failed node doesn't stop the others
+		def deploy_computes(batch):
+			compute_configs = {}
+			for node in batch:
+				compute_configs[node] = {
+					vc_out.get_vc_out(node): "/root/vc-out.xml"
+				}
+			failed = image_manager.prepare_computes(
+				batch, network_conf, compute_configs)
+			for node in batch:
+				if node not in failed and not self.boot(node):
+					failed[node] = "unable to boot"
+			return failed
+
+		nodes = vc_out.get_compute_names()
+		batches = [tuple(nodes[i:i + batch_size])
+			for i in range(0, len(nodes), batch_size)]
+		self.logger.info("Deploying %d compute nodes in batches of %d, %d at a time" % (
+			len(nodes), batch_size, concurrency))
+		results, batch_errors = pragma.utils.parallel_map(
+			deploy_computes, batches, concurrency)
+		errors = {}
+		for batch in batches:
+			if batch in batch_errors:
+				for node in batch:
+					errors[node] = batch_errors[batch]
+			else:
+				errors.update(results[batch])
 		image_manager.boot_cleanup()
+		if errors:
+			for node in sorted(errors.keys()):
+				sys.stderr.write("Error deploying node %s: %s\n" % (
+					node, errors[node]))
+			self.logger.error("Failed to deploy %d of %d compute nodes: %s" % (
+				len(errors), len(nodes), ", ".join(sorted(errors.keys()))))
+			return False
+		return True
 
 	def find_free_ip(self, avail_ips):
 		"""
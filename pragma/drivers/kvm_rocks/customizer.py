@@ -0,0 +1,219 @@
+import logging
+import os
+
+try:
+	import guestfs
+except ImportError:
+	guestfs = None
+
+logger = logging.getLogger('pragma.drivers.kvm_rocks.customizer')
+
+
+class GuestfsSession:
+	"""
+	Customize disk images through a single libguestfs appliance, without
+	mounting them with FUSE.  Images are added with their delete and install
+	specs and apply() launches the appliance once for all of them, so the
+	appliance boot and OS inspection are paid once per batch instead of
+	once per image.
+	"""
+
+	def __init__(self):
+		self.images = [] # format [(path, delete_spec, install_spec), ...]
+
+	@staticmethod
+	def available():
+		"""
+		Check whether the libguestfs python bindings are installed
+
+		:return: True if available; otherwise False
+		"""
+		return guestfs is not None
+
+	def add(self, path, delete_spec, install_spec):
+		"""
+		Add an image to customize
+
+		:param path: Path to image
+		:param delete_spec: Array of file patterns to move aside on image
+		:param install_spec: Hash array of file to install on image
+		:return:
+		"""
+		self.images.append((path, delete_spec, install_spec))
+
+	def apply(self):
+		"""
+		Launch the appliance with all added images and customize each one.
+		Copies of an image using LVM have the same volume group names and
+		uuids, so only one of them can be activated in an appliance; such
+		images are customized with one appliance each.
+
+		:return: Hash array of images that could not be customized where
+			the key is the path to image and the value is the error
+		"""
+		failed = self.run(self.images)
+		if failed is None:
+			logger.info("Images share LVM volume groups, customizing them one at a time")
+			failed = {}
+			for image in self.images:
+				failed.update(self.run([image]))
+		for path in failed:
+			logger.error("Problem customizing %s: %s" % (path, failed[path]))
+		return failed
+
+	def run(self, images):
+		"""
+		Customize images with one appliance
+
+		:param images: Array of (path, delete_spec, install_spec) tuples
+		:return: Hash array of images that could not be customized where
+			the key is the path to image and the value is the error, or None
+			if several images share LVM volume groups
+		"""
+		failed = {}
+		if not images:
+			return failed
+		g = guestfs.GuestFS(python_return_dict=True)
+		try:
+			for path, delete_spec, install_spec in images:
+				g.add_drive_opts(path)
+			logger.info("Launching appliance for %d images" % len(images))
+			g.launch()
+			if len(images) > 1 and self.sharesVolumeGroups(g):
+				return None
+			roots = {}
+			for root in g.inspect_os():
+				try:
+					roots.setdefault(self.disk(g, root), root)
+				except RuntimeError as e:
+					logger.warning("Unable to find the disk of %s: %s" % (root, e))
+			for device, (path, delete_spec, install_spec) in zip(g.list_devices(), images):
+				if device not in roots:
+					failed[path] = "No operating system found in %s" % path
+					continue
+				try:
+					self.mount(g, device, roots[device])
+					self.customize(g, path, delete_spec, install_spec)
+				except RuntimeError as e:
+					failed[path] = str(e)
+				try:
+					g.umount_all()
+				except RuntimeError as e:
+					failed.setdefault(path, str(e))
+			# flush all images to disk
+			g.shutdown()
+		except RuntimeError as e:
+			for path, delete_spec, install_spec in images:
+				failed.setdefault(path, str(e))
+		finally:
+			g.close()
+		return failed
+
+	@staticmethod
+	def sharesVolumeGroups(g):
+		"""
+		Check whether LVM physical volumes of the launched disks were left
+		out because they duplicate the uuid of another one
+
+		:param g: Launched libguestfs handle
+		:return: True if some physical volumes are duplicates
+		"""
+		members = 0
+		for device in g.list_devices() + g.list_partitions():
+			try:
+				if g.vfs_type(device) == "LVM2_member":
+					members += 1
+			except RuntimeError:
+				pass
+		pvs = g.pvs()
+		return members > len(pvs) or \
+			len(set([g.pvuuid(pv) for pv in pvs])) < len(pvs)
+
+	@staticmethod
+	def disk(g, filesystem):
+		"""
+		Find the disk holding a filesystem: the disk of its first physical
+		volume for a logical volume, otherwise the disk of its partition
+
+		:param g: Launched libguestfs handle
+		:param filesystem: Device of the filesystem
+		:return: Appliance device of the disk
+		"""
+		if g.is_lv(filesystem):
+			lvuuid = g.lvuuid(filesystem)
+			for vg in g.vgs():
+				if lvuuid in g.vglvuuids(vg):
+					pvuuids = g.vgpvuuids(vg)
+					for pv in g.pvs():
+						if g.pvuuid(pv) in pvuuids:
+							return GuestfsSession.disk(g, pv)
+			raise RuntimeError("no physical volume found for %s" % filesystem)
+		if filesystem in g.list_devices():
+			return filesystem
+		return g.part_to_dev(filesystem)
+
+	def mount(self, g, device, root):
+		"""
+		Mount the filesystems of the OS on device.  The images of a batch
+		may be copies of the same image, so a filesystem fstab names by
+		label or uuid is mounted from device even if inspection resolved
+		it to another disk.
+
+		:param g: Launched libguestfs handle
+		:param device: Appliance device of the image
+		:param root: Root filesystem found by inspection
+		:return:
+		"""
+		mountpoints = g.inspect_get_mountpoints(root)
+		for mountpoint in sorted(mountpoints.keys(), key=len):
+			filesystem = self.onDisk(g, device, mountpoints[mountpoint])
+			if filesystem is None:
+				logger.warning("Skipping %s, %s is not on %s" % (
+					mountpoint, mountpoints[mountpoint], device))
+				continue
+			g.mount(filesystem, mountpoint)
+
+	def onDisk(self, g, device, filesystem):
+		"""
+		Find the filesystem of device standing for filesystem
+
+		:param g: Launched libguestfs handle
+		:param device: Appliance device of the image
+		:param filesystem: Device of a filesystem named in fstab
+		:return: filesystem if it is on device, otherwise the filesystem of
+			device with the same uuid, or None if there is none
+		"""
+		try:
+			if self.disk(g, filesystem) == device:
+				return filesystem
+			uuid = g.vfs_uuid(filesystem)
+		except RuntimeError:
+			return None
+		for candidate in g.list_filesystems().keys():
+			try:
+				if g.vfs_uuid(candidate) == uuid and self.disk(g, candidate) == device:
+					return candidate
+			except RuntimeError:
+				continue
+		return None
+
+	def customize(self, g, path, delete_spec, install_spec):
+		"""
+		Move aside files matching delete_spec and upload install_spec files
+		on the mounted image
+
+		:param g: Launched libguestfs handle
+		:param path: Path to image
+		:param delete_spec: Array of file patterns to move aside on image
+		:param install_spec: Hash array of file to install on image
+		:return:
+		"""
+		for file_pat in delete_spec:
+			for filename in g.glob_expand(file_pat):
+				oldfile = os.path.join(os.path.dirname(filename),
+					"old-%s" % os.path.basename(filename))
+				logger.info("Moving %s to %s in %s" % (filename, oldfile, path))
+				g.mv(filename, oldfile)
+		for filename, dest in install_spec.iteritems():
+			logger.info("Copying %s to %s in %s" % (filename, dest, path))
+			g.upload(filename, dest)
@@ -0,0 +1,126 @@
+import logging
+import os
+import pipes
+import pragma.utils
+import time
+
+logger = logging.getLogger('pragma.drivers.kvm_rocks.distribute')
+
+
+class ChainDistribution:
+	"""
+	Copy an image to several VM containers through chains of hosts.  The
+	frontend streams the image to the first host of each chain, which
+	writes it to disk while forwarding the stream to the next host of the
+	chain, and so on.  The frontend sends the image once per chain instead
+	of once per host, and since hosts forward while receiving, a chain
+	takes about the time of a single copy.
+	"""
+	# run on each host with arguments: dest [next-host next-dest ...]
+	RELAY = """set -o pipefail
+dest=$1; shift
+extract() {
+	tar -C "$(dirname "$dest")" --xform="s/.*/$(basename "$dest")/" -xf -
+}
+if [ $# -eq 0 ]; then
+	extract
+	exit $?
+fi
+next=$1; shift
+fifo=$(mktemp -u) && mkfifo "$fifo" || exit 1
+extract < "$fifo" &
+pid=$!
+tee "$fifo" | ssh "$next" "bash -c $(printf %q "$BASH_EXECUTION_STRING") relay $(printf '%q ' "$@")"
+rc=$?
+wait $pid || rc=1
+rm -f "$fifo"
+exit $rc
+"""
+
+	def __init__(self, image, targets, chains=1):
+		"""
+		:param image: Path to local image
+		:param targets: Array of (host, dest) tuples where dest is the path
+			of the copy on host
+		:param chains: Number of chains the frontend sends to at the same time
+		"""
+		self.image = image
+		self.targets = targets
+		self.chains = max(1, chains)
+
+	def split(self):
+		"""
+		Split targets in chains of about the same length
+
+		:return: Array of chains, each one a tuple of targets
+		"""
+		nchains = min(self.chains, len(self.targets))
+		return [tuple(self.targets[i::nchains]) for i in range(nchains)]
+
+	@staticmethod
+	def receive_command(chain):
+		"""
+		Command run on the first host of chain to extract the image stream
+		and forward it to the rest of the chain.  The relay script gets the
+		remaining hops as arguments and forwards itself with them, so the
+		command grows linearly with the length of the chain.
+
+		:param chain: Tuple of (host, dest) targets
+		:return: Shell command reading the image stream from stdin
+		"""
+		args = [chain[0][1]]
+		for host, dest in chain[1:]:
+			args.extend([host, dest])
+		return "bash -c %s relay %s" % (pipes.quote(ChainDistribution.RELAY),
+			" ".join([pipes.quote(arg) for arg in args]))
+
+	def send_command(self, chain):
+		"""
+		Command run on the frontend to stream image to a chain of hosts
+
+		:param chain: Tuple of (host, dest) targets
+		:return: Command as an array of arguments
+		"""
+		return ["bash", "-o", "pipefail", "-c", "tar -Scf - -C %s %s | ssh %s %s" % (
+			pipes.quote(os.path.dirname(self.image)),
+			pipes.quote(os.path.basename(self.image)),
+			chain[0][0], pipes.quote(self.receive_command(chain)))]
+
+	def send(self, chain):
+		"""
+		Stream image to a chain of hosts
+
+		:param chain: Tuple of (host, dest) targets
+		:return: True if the whole chain received the image; otherwise False
+		"""
+		start = time.time()
+		(out, ec) = pragma.utils.getOutputAsList(self.send_command(chain))
+		hosts = " -> ".join([host for host, dest in chain])
+		if ec != 0:
+			logger.error("Problem sending %s to %s: %s" % (
+				self.image, hosts, "\n".join(out)))
+			return False
+		logger.info("Sent %s to %s in %.1f secs" % (
+			self.image, hosts, time.time() - start))
+		return True
+
+	def delivered(self, target):
+		"""
+		Check that target has a complete copy of image
+
+		:param target: Tuple (host, dest)
+		:return: True if complete; otherwise False
+		"""
+		host, dest = target
+		(out, ec) = pragma.utils.getOutputAsList(
+			["ssh", host, "stat -c %%s %s" % pipes.quote(dest)])
+		return ec == 0 and out[0].strip() == str(os.path.getsize(self.image))
+
+	def run(self):
+		"""
+		Send image to all targets
+
+		:return: Array of targets that did not receive a complete copy
+		"""
+		pragma.utils.parallel_map(self.send, self.split(), self.chains)
+		return [target for target in self.targets if not self.delivered(target)]
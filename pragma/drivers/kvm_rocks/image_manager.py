@@ -6,7 +6,9 @@ import re
 import shutil
 import socket
 import sys
-import time
+import threading
+from pragma.drivers.kvm_rocks.customizer import GuestfsSession
+from pragma.drivers.kvm_rocks.distribute import ChainDistribution
 
 logger = logging.getLogger('pragma.drivers.kvm_rocks.image_manager')
 
@@ -14,7 +16,7 @@ logger = logging.getLogger('pragma.drivers.kvm_rocks.image_manager')
 class ImageManager:
 	LIST_VM_PATTERN = "^(\S*%s\S*?)?:?\s*\d+\s+\d+\s+\d+\s+\S+\s+(\S+)\s+\S+\s+file:(\S+),vda,virtio"
 	LIST_DISK_PATTERN = "^(\S*%s\S*?)?:?\s*\d+\s+\d+\s+\d+\s+\S+\s+(\S+)\s+\S+\s+(\S+),vda,virtio"
-	SLEEP_FOR_UMOUNT = 10
+	UMOUNT_TIMEOUT = 600
 
 	def __init__(self, fe_name):
 		"""
@@ -25,8 +27,11 @@ class ImageManager:
 		self.fe_name = fe_name
 		self.compute_names = []
 		self.temp_dir = None
+		self.config_disk = False # configure computes with a config disk
+		self.distribution_chains = 1 # chains of containers images are sent through
 		self.phy_hosts = {}
 		self.disks = {}
+		self.multi_disk = set() # nodes defined with disks besides vda
 		(out, ec) = pragma.utils.getRocksOutputAsList(
 			"list host vm showdisks=true")
 		host_pat = re.compile(self.LIST_VM_PATTERN % self.fe_name)
@@ -38,6 +43,8 @@ class ImageManager:
 					node = self.fe_name
 				self.phy_hosts[node] = result.group(2)
 				self.disks[node] = result.group(3)
+				if re.search(",vdb,", line):
+					self.multi_disk.add(node)
 
 	def boot_cleanup(self):
 		"""
@@ -63,6 +70,48 @@ class ImageManager:
 			sys.stderr.write("Unable to clean disks of type %s\n" % disk_spec)
 			return False
 
+	def customize_image(self, path, delete_spec, install_spec):
+		"""
+		Move aside files matching delete_spec and install install_spec files
+		on the specified image
+
+		:param path: Path to image
+		:param delete_spec: Array of files to delete on image
+		:param install_spec: Hash array of file to install on image
+		:return: 1 if the image was customized, otherwise 0
+		"""
+		if self.customize_images([(path, delete_spec, install_spec)]):
+			return 0
+		return 1
+
+	def customize_images(self, images):
+		"""
+		Customize several images with one libguestfs appliance, or mount
+		each one with guestmount when the libguestfs python bindings are not
+		installed
+
+		:param images: Array of (path, delete_spec, install_spec) tuples
+		:return: Hash array of images that could not be customized where
+			the key is the path to image and the value is the error
+		"""
+		if GuestfsSession.available():
+			session = GuestfsSession()
+			for path, delete_spec, install_spec in images:
+				session.add(path, delete_spec, install_spec)
+			return session.apply()
+
+		failed = {}
+		for path, delete_spec, install_spec in images:
+			try:
+				pid, mnt = self.mount_image(path)
+				self.safe_remove_from_image(mnt, delete_spec)
+				self.install_to_image(mnt, install_spec)
+				if not self.umount_image(pid, mnt):
+					failed[path] = "unable to umount %s" % mnt
+			except (IOError, OSError) as e:
+				failed[path] = str(e)
+		return failed
+
 	@staticmethod
 	def factory(vc_in, vc_out, temp_dir):
 		"""
@@ -184,6 +233,23 @@ class ImageManager:
 		"""
 		raise "Unimplemented for ImageManager, %s" % self.__class__.__name__
 
+	def prepare_computes(self, nodes, delete_spec, install_specs):
+		"""
+		Prepare compute nodes of new virtual cluster for booting
+
+		:param nodes: Names of compute nodes to boot
+		:param delete_spec: Array of files to delete on images
+		:param install_specs: Hash array where the key is the node and the
+			value is the hash array of files to install on its image
+		:return: Hash array of nodes that could not be prepared where the
+			key is the node and the value is the error
+		"""
+		failed = {}
+		for node in nodes:
+			if not self.prepare_compute(node, delete_spec, install_specs[node]):
+				failed[node] = "unable to prepare image"
+		return failed
+
 	def prepare_frontend(self, delete_spec, install_spec):
 		"""
 		Prepare frontend of new virtual cluster for booting
@@ -215,8 +281,10 @@ class ImageManager:
 
 	def umount_image(self, pid, path):
 		"""
-		Unmount image at specified path
+		Unmount image at specified path and wait for the guestmount process
+		to exit, which is when the image is written back and closed
 
+		:param pid: Pid of the guestmount process
 		:param path: Path to mounted image
 		:return:
 		"""
@@ -225,22 +293,23 @@ class ImageManager:
 			logger.error("Unable to umount %s" % path)
 			return 0
 
-		while True:
-			logger.info("Waiting for guestmount process %s to exit" % pid)
-			time.sleep(ImageManager.SLEEP_FOR_UMOUNT)
+		def guestmount_exited():
 			try:
 				os.kill(pid, 0)
 			except OSError:
-				logger.info("Verified guestmount process %s has completed" % pid)
-        			break
-		logger.info("Waiting another %i secs for good measure" % ImageManager.SLEEP_FOR_UMOUNT)
-		time.sleep(ImageManager.SLEEP_FOR_UMOUNT)
+				return True
+			return False
+
+		if pragma.utils.wait_until(guestmount_exited, ImageManager.UMOUNT_TIMEOUT,
+			"guestmount process %s to exit" % pid) is None:
+			return 0
 
 		os.rmdir(path)
+		return 1
 		
 
 class ZfsImageManager(ImageManager):
-	SLEEP_FOR_UNMAPPED = 5
+	UNMAP_TIMEOUT = 600
 
 	def __init__(self, fe_name, fe_spec, compute_spec):
 		"""
@@ -385,13 +454,13 @@ class ZfsImageManager(ImageManager):
 
 		return (vol, pool, nas)
 
-	def mount_from_nas(self, vol, zfs_spec):
+	def map_from_nas(self, vol, zfs_spec):
 		"""
-		Mount specified volume from NAS device
+		Map specified volume from NAS device to our physical frontend
 
 		:param vol:  Name of volume existing on NAS device
 		:param zfs_spec:  ZFS info on specified virtual cluster node
-		:return:
+		:return: Path to the mapped device or None if it can't be mapped
 		"""
 		# remote mount image to our phy frontend
 		(out, ec) = pragma.utils.getRocksOutput(
@@ -404,54 +473,51 @@ class ZfsImageManager(ImageManager):
 		result = storagedev_pat.search(out)
 		if result:
 			self.disks[vol] = result.group(1)
-
-		# mount volume
-		return self.mount_image(self.disks[vol])
+		return self.disks.get(vol)
 
 	def prepare_compute(self, node, delete_spec, install_spec):
 		"""
-		Clone compute ZFS image and mount it to frontend.  Modify image with
-		network configuration and then unmount image so it's ready to be booted.
+		Clone compute ZFS image and map it to frontend.  Modify image with
+		network configuration and then unmap image so it's ready to be booted.
 
 		:param node: Name of compute node to boot
 		:param delete_spec: Array of files to delete on image
 		:param install_spec: Hash array of file to install on image
-		:return:
+		:return: 1 if the image is ready, otherwise 0
 		"""
 		self.clone_and_set_zfs_image(node, self.compute)
-		pid, compute_mnt = self.mount_from_nas(node, self.compute)
-		self.safe_remove_from_image(compute_mnt, delete_spec)
-		self.install_to_image(compute_mnt, install_spec)
-		self.umount_from_nas(pid, compute_mnt, node, self.compute)
+		device = self.map_from_nas(node, self.compute)
+		if device is None:
+			return 0
+		customized = self.customize_image(device, delete_spec, install_spec)
+		self.unmap_from_nas(node, self.compute)
+		return customized
 
 	def prepare_frontend(self, delete_spec, install_spec):
 		"""
-		Clone frontend ZFS image and mount it to frontend.  Modify image with
-		network configuration and then unmount image so it's ready to be booted.
+		Clone frontend ZFS image and map it to frontend.  Modify image with
+		network configuration and then unmap image so it's ready to be booted.
 
 		:param delete_spec: Array of files to delete on image
 		:param install_spec: Hash array of file to install on image
-		:return:
+		:return: 1 if the image is ready, otherwise 0
 		"""
 		self.clone_and_set_zfs_image(self.fe_name, self.frontend)
-		pid, fe_mnt = self.mount_from_nas(self.fe_name, self.frontend)
-		self.safe_remove_from_image(fe_mnt, delete_spec)
-		self.install_to_image(fe_mnt, install_spec)
-		self.umount_from_nas(pid, fe_mnt, self.fe_name, self.frontend)
+		device = self.map_from_nas(self.fe_name, self.frontend)
+		if device is None:
+			return 0
+		customized = self.customize_image(device, delete_spec, install_spec)
+		self.unmap_from_nas(self.fe_name, self.frontend)
+		return customized
 
-	def umount_from_nas(self, pid, mnt, name, zfs_spec):
+	def unmap_from_nas(self, name, zfs_spec):
 		"""
-		Unmount volume from local temp directory and unmount volume from NAS
+		Unmap volume of node from our physical frontend
 
-		:param mnt: Path to local directory for mounted volume
 		:param name:  Name of node
 		:param zfs_spec: ZFS info on node type
 		:return:
 		"""
-		# unmount volume
-		self.umount_image(pid, mnt)
-
-		# unmount from nas
 		(out, ec) = pragma.utils.getRocksOutputAsList(
 			"remove host storagemap %s %s-vol" % (
 				zfs_spec['host'], name))
@@ -467,18 +533,24 @@ class ZfsImageManager(ImageManager):
 
 		:return: True if unmapped; otherwise False
 		"""
-	        status = ZfsImageManager.get_disk_status(node, disk)
-		while status != 'unmapped':
-			print "  Status of disk for node %s is %s; sleep for %i secs" % (
-				node, status, ZfsImageManager.SLEEP_FOR_UNMAPPED)
-			time.sleep(ZfsImageManager.SLEEP_FOR_UNMAPPED)
-			status = ZfsImageManager.get_disk_status(node, disk)
-		print "  Disk for node %s is %s" % (node, status)
+		status = [None]
+
+		def unmapped():
+			status[0] = ZfsImageManager.get_disk_status(node, disk)
+			return status[0] == 'unmapped'
+
+		waited = pragma.utils.wait_until(unmapped, ZfsImageManager.UNMAP_TIMEOUT,
+			"disk of node %s to be unmapped" % node, interval=1)
+		print "  Disk for node %s is %s" % (node, status[0])
+		return waited is not None
 
 
 class NfsImageManager(ImageManager):
-	SET_DISK_CMD = "set host vm %s disk=\"file:%s/%s.vda,vda,virtio\"" 
+	SET_DISK_CMD = "set host vm %s disk=\"file:%s,vda,virtio\""
+	SET_CONFIG_DISK_CMD = "set host vm %s disk=\"file:%s,vda,virtio file:%s,vdb,virtio\""
 	SPARSE_CP_CMD = "cp --sparse=always %s %s"
+	CONFIG_DISK_SUFFIX = ".config.iso"
+	CONFIG_DISK_LABEL = "VCCONFIG"
 
 	def __init__(self, fe_name, fe_img, compute_img, vc_dir, kvm_dir):
 		"""
@@ -496,7 +568,10 @@ class NfsImageManager(ImageManager):
 		self.compute_img = compute_img
 		self.vc_dir = vc_dir
 		self.diskdir = kvm_dir
-		self.tmp_compute_img = None
+		self.tmp_compute_imgs = {} # node -> copy of compute image being prepared
+		self.golden_img = None     # compute image prepared once for all nodes
+		self.golden_copies = {}    # container -> path to its copy of golden_img
+		self.lock = threading.Lock()
 		self.our_phy_frontend = socket.gethostname().split(".")[0]
 		if self.diskdir:
 			self.set_rocks_disk_paths()
@@ -505,8 +580,18 @@ class NfsImageManager(ImageManager):
 		"""
 		Cleanup any temporary state
 		"""
-		if self.tmp_compute_img is not None:
-			os.remove(self.tmp_compute_img)
+		for tmp_compute_img in self.tmp_compute_imgs.values():
+			if os.path.exists(tmp_compute_img):
+				os.remove(tmp_compute_img)
+		self.tmp_compute_imgs = {}
+		self.golden_img = None
+		for host, golden_copy in self.golden_copies.items():
+			(out, ec) = pragma.utils.getOutputAsList(
+				"ssh %s rm -f %s" % (host, golden_copy))
+			if ec != 0:
+				logger.error("Problem removing %s from %s: %s" % (
+					golden_copy, host, "\n".join(out)))
+		self.golden_copies = {}
 
 	@staticmethod
 	def clean_disk(node, disk_spec, host):
@@ -521,7 +606,7 @@ class NfsImageManager(ImageManager):
 		result = re.search("file:([^,]+)", disk_spec)
 		disk = result.group(1)
 		print "  Removing disk %s from node %s" % (disk, host)
-		cmd = "rm -f %s" % disk
+		cmd = "rm -f %s %s%s" % (disk, disk, NfsImageManager.CONFIG_DISK_SUFFIX)
 		our_phy_frontend = socket.gethostname().split(".")[0]
 		if host != our_phy_frontend:
 			cmd = "ssh %s %s" % (host, cmd)
@@ -530,70 +615,276 @@ class NfsImageManager(ImageManager):
 			sys.stderr.write("Problem removing disk %s: %s\n" % (
 				host, "\n".join(out)))
 			return False
+		# drop the config disk from the disk definition
+		(out, exitcode) = pragma.utils.getRocksOutputAsList(
+			NfsImageManager.SET_DISK_CMD % (node, disk))
+		if exitcode != 0:
+			sys.stderr.write("Problem resetting disk of node %s: %s\n" % (
+				node, "\n".join(out)))
+			return False
 		return True
 
-	def create_tmp_compute(self):
+	def create_tmp_compute(self, node):
 		"""
-		Create a copy of compute image that can be modifed
+		Create a copy of compute image that can be modifed for the specified
+		node, so nodes can be prepared at the same time
 
-		:return:
+		:param node: Name of compute node the copy is for
+		:return: Path to the copy or None if the copy failed
+		"""
+		tmp_compute_img = os.path.join(self.temp_dir, "compute-%s.img" % node)
+		self.tmp_compute_imgs[node] = tmp_compute_img
+
+		if not self.copy_image(os.path.join(self.vc_dir, self.compute_img),
+				tmp_compute_img):
+			return None
+		return tmp_compute_img
+
+	def copy_image(self, image, disk):
 		"""
-		self.tmp_compute_img = os.path.join(self.temp_dir, "compute.img")
+		Make a sparse copy of a repository image
 
-		(out, ec) = pragma.utils.getOutputAsList(self.SPARSE_CP_CMD % (
-				os.path.join(self.vc_dir, self.compute_img), 
-				self.tmp_compute_img))
+		:param image: Path to repository image
+		:param disk: Path to the copy
+		:return: True if copied; otherwise False
+		"""
+		(out, ec) = pragma.utils.getOutputAsList(self.SPARSE_CP_CMD % (image, disk))
 		if ec != 0:
-			logger.error("Problem copying temp image %s: %s" % (
-				self.tmp_compute_img,
-				"\n".join(out)))
+			logger.error("Problem copying %s to %s: %s" % (
+				image, disk, "\n".join(out)))
+			return False
+		return True
 
 	def prepare_compute(self, node, delete_spec, install_spec):
 		"""
-		Create a copy of specified compute image if needed, mount it and install
-		new network configuration. Unmount volume and copy it over to
-		remote node.
+		Create a copy of specified compute image for the node and install new
+		network configuration. Copy it over to remote node.
 
 		:param node: Name of compute node to boot
 		:param delete_spec: Array of files to delete on image
 		:param install_spec: Hash array of file to install on image
+		:return: 1 if the image was copied to the node, otherwise 0
+		"""
+		if self.prepare_computes([node], delete_spec, {node: install_spec}):
+			return 0
+		return 1
+
+	def prepare_computes(self, nodes, delete_spec, install_specs):
+		"""
+		Create a copy of specified compute image for each node, install new
+		network configuration in all copies with one libguestfs appliance
+		and copy each one over to its remote node.  Each node has its own
+		copy, so several batches can be prepared at the same time.
+
+		:param nodes: Names of compute nodes to boot
+		:param delete_spec: Array of files to delete on images
+		:param install_specs: Hash array where the key is the node and the
+			value is the hash array of files to install on its image
+		:return: Hash array of nodes that could not be prepared where the
+			key is the node and the value is the error
+		"""
+		if self.config_disk:
+			return self.prepare_computes_config_disk(nodes, delete_spec, install_specs)
+		failed = {}
+		images = {}
+		for node in nodes:
+			tmp_compute_img = self.create_tmp_compute(node)
+			if tmp_compute_img is None:
+				failed[node] = "unable to copy compute image"
+			else:
+				images[node] = tmp_compute_img
+
+		errors = self.customize_images([(images[node], delete_spec,
+			install_specs[node]) for node in sorted(images.keys())])
+		for node in sorted(images.keys()):
+			if images[node] in errors:
+				failed[node] = errors[images[node]]
+			elif not self.send_compute(node, images[node]):
+				failed[node] = "unable to copy image to %s" % self.phy_hosts[node]
+			elif not self.detach_config_disk(node):
+				failed[node] = "unable to detach config disk"
+			os.remove(images[node])
+			del self.tmp_compute_imgs[node]
+		return failed
+
+	def prepare_computes_config_disk(self, nodes, delete_spec, install_specs):
+		"""
+		Boot compute nodes from the same image, with the node configuration
+		on a small per node config disk.  The compute image is prepared once
+		for all nodes and sent once to each VM container through chains of
+		containers, where the node disks are local copies of it.
+		install_specs files are written to an iso labelled
+		CONFIG_DISK_LABEL, at their path on the image, which the node reads
+		at boot.
+
+		:param nodes: Names of compute nodes to boot
+		:param delete_spec: Array of files to delete on the shared image
+		:param install_specs: Hash array where the key is the node and the
+			value is the hash array of files to write on its config disk
+		:return: Hash array of nodes that could not be prepared where the
+			key is the node and the value is the error
+		"""
+		failed = {}
+		for node in nodes:
+			golden_copy = self.send_golden_compute(node, delete_spec)
+			if golden_copy is None:
+				failed[node] = "unable to copy compute image to %s" % self.phy_hosts[node]
+				continue
+			(out, ec) = pragma.utils.getOutputAsList("ssh %s %s" % (
+				self.phy_hosts[node],
+				self.SPARSE_CP_CMD % (golden_copy, self.disks[node])))
+			if ec != 0:
+				logger.error("Problem copying %s on %s: %s" % (
+					golden_copy, self.phy_hosts[node], "\n".join(out)))
+				failed[node] = "unable to copy compute image on %s" % self.phy_hosts[node]
+				continue
+			if not self.send_config_disk(node, install_specs[node]):
+				failed[node] = "unable to create config disk"
+		return failed
+
+	def send_golden_compute(self, node, delete_spec):
+		"""
+		Prepare the shared compute image and distribute it to the VM
+		containers of all compute nodes the first time it is needed
+
+		:param node: Name of compute node
+		:param delete_spec: Array of files to delete on the shared image
+		:return: Path to the copy on the VM container of node or None if
+			failed
+		"""
+		with self.lock:
+			if self.golden_img is None:
+				golden_img = self.create_tmp_compute("golden")
+				if golden_img is None or self.customize_image(golden_img, delete_spec, {}) == 0:
+					return None
+				self.golden_img = golden_img
+				self.distribute_golden_compute()
+			return self.golden_copies.get(self.phy_hosts[node])
+
+	def distribute_golden_compute(self):
+		"""
+		Copy the shared compute image once to each VM container through
+		chains of containers forwarding it to each other, see
+		ChainDistribution.  Containers the chains failed to reach are sent
+		the image directly.
+
 		:return:
 		"""
-		if self.tmp_compute_img is None:
-			self.create_tmp_compute()
-		pid, compute_mnt = self.mount_image(self.tmp_compute_img)
-		self.safe_remove_from_image(compute_mnt, delete_spec)
-		self.install_to_image(compute_mnt, install_spec)
-		self.umount_image(pid, compute_mnt)
+		targets = {}
+		for node in self.compute_names:
+			host = self.phy_hosts[node]
+			if host not in targets:
+				targets[host] = os.path.join(os.path.dirname(self.disks[node]),
+					"%s-compute.img" % self.fe_name)
+		targets = sorted(targets.items())
+		logger.info("Distributing %s to %d VM containers in %d chains" % (
+			self.golden_img, len(targets), min(self.distribution_chains, len(targets))))
+		failed = ChainDistribution(self.golden_img, targets,
+			self.distribution_chains).run()
+		for host, dest in targets:
+			if (host, dest) in failed:
+				logger.info("Sending %s directly to %s" % (self.golden_img, host))
+				if not self.send_image(self.golden_img, host, dest):
+					pragma.utils.getOutputAsList("ssh %s rm -f %s" % (host, dest))
+					continue
+			self.golden_copies[host] = dest
+
+	def send_config_disk(self, node, install_spec):
+		"""
+		Create the config disk of node and attach it next to its disk
+
+		:param node: Name of compute node
+		:param install_spec: Hash array of file to write on config disk
+		:return: True if attached; otherwise False
+		"""
+		mkisofs = pragma.utils.which("genisoimage") or pragma.utils.which("mkisofs")
+		if mkisofs is None:
+			logger.error("genisoimage or mkisofs is required to create config disks")
+			return False
+		config_disk = os.path.join(self.temp_dir, "%s%s" % (node, self.CONFIG_DISK_SUFFIX))
+		graft_points = ["%s=%s" % (dest.lstrip("/"), filename)
+			for filename, dest in install_spec.iteritems()]
+		(out, ec) = pragma.utils.getOutputAsList([mkisofs, "-quiet", "-r", "-J",
+			"-V", self.CONFIG_DISK_LABEL, "-o", config_disk, "-graft-points"] + graft_points)
+		if ec != 0:
+			logger.error("Problem creating config disk %s: %s" % (
+				config_disk, "\n".join(out)))
+			return False
+		remote_config_disk = self.disks[node] + self.CONFIG_DISK_SUFFIX
+		sent = self.send_image(config_disk, self.phy_hosts[node], remote_config_disk)
+		os.remove(config_disk)
+		if not sent:
+			return False
+		(out, ec) = pragma.utils.getRocksOutputAsList(self.SET_CONFIG_DISK_CMD % (
+			node, self.disks[node], remote_config_disk))
+		if ec != 0:
+			logger.error("Unable to attach config disk to %s: %s" % (
+				node, "\n".join(out)))
+			return False
+		return True
+
+	def detach_config_disk(self, node):
+		"""
+		Set the disk definition of node back to its single disk if a config
+		disk was attached by an earlier boot
+
+		:param node: Name of compute node
+		:return: True if node has a single disk; otherwise False
+		"""
+		if node not in self.multi_disk:
+			return True
+		(out, ec) = pragma.utils.getRocksOutputAsList(self.SET_DISK_CMD % (
+			node, self.disks[node]))
+		if ec != 0:
+			logger.error("Unable to detach config disk from %s: %s" % (
+				node, "\n".join(out)))
+			return False
+		self.multi_disk.discard(node)
+		return True
+
+	def send_compute(self, node, tmp_compute_img):
+		"""
+		Copy prepared compute image to the disk of node on its VM container
+
+		:param node: Name of compute node
+		:param tmp_compute_img: Path to prepared image
+		:return: True if copied; otherwise False
+		"""
+		return self.send_image(tmp_compute_img, self.phy_hosts[node], self.disks[node])
+
+	def send_image(self, image, host, dest):
+		"""
+		Copy a local image to dest on the specified VM container
+
+		:param image: Path to local image
+		:param host: Name of VM container
+		:param dest: Path of the copy on the VM container
+		:return: True if copied; otherwise False
+		"""
 		(out, ec) = pragma.utils.getOutputAsList("sh -c -o pipefail \"tar -Scf - -C '%s' '%s' | ssh %s tar -C '%s' --xform=s/.*/%s/ -xf -\"" % (
-			os.path.dirname(self.tmp_compute_img),
-			os.path.basename(self.tmp_compute_img),
-			self.phy_hosts[node],
-			os.path.dirname(self.disks[node]),
-			os.path.basename(self.disks[node])))
+			os.path.dirname(image),
+			os.path.basename(image),
+			host,
+			os.path.dirname(dest),
+			os.path.basename(dest)))
 		if ec != 0:
 			logger.error("tar command failed: %s" % ("\n".join(out)))
+			return False
+		return True
 
 	def prepare_frontend(self, delete_spec, install_spec):
 		"""
-		Create a copy of specified frontend image, mount it and install
-		new network configuration. Unmount volume.
+		Create a copy of specified frontend image and install new network
+		configuration.
 
 		:param delete_spec: Array of files to delete on image
 		:param install_spec: Hash array of file to install on image
-		:return:
+		:return: 1 if the image is ready, otherwise 0
 		"""
-		(out, ec) = pragma.utils.getOutputAsList(self.SPARSE_CP_CMD % (
-				os.path.join(self.vc_dir, self.frontend_img),
-				self.disks[self.fe_name]))
-		if ec != 0:
-			logger.error("Problem copying frontend image: %s" % (
-				"\n".join(out)))
+		if not self.copy_image(os.path.join(self.vc_dir, self.frontend_img),
+				self.disks[self.fe_name]):
 			return 0
-		pid, fe_mnt = self.mount_image(self.disks[self.fe_name])
-		self.safe_remove_from_image(fe_mnt, delete_spec)
-		self.install_to_image(fe_mnt, install_spec)
-		self.umount_image(pid, fe_mnt)
+		return self.customize_image(self.disks[self.fe_name], delete_spec, install_spec)
 
 	def set_rocks_disk_paths(self):
 		"""
@@ -609,5 +900,7 @@ class NfsImageManager(ImageManager):
 				logger.error("%s does not exist on %s" % (
 					self.diskdir, self.phy_hosts[node]))
 				continue
-			pragma.utils.getRocksOutputAsList(
-				self.SET_DISK_CMD % (node, self.diskdir, node))
+			disk = os.path.join(self.diskdir, "%s.vda" % node)
+			pragma.utils.getRocksOutputAsList(self.SET_DISK_CMD % (node, disk))
+			self.disks[node] = disk
+			self.multi_disk.discard(node)
@@ -1,4 +1,5 @@
 import xml.etree.ElementTree as ET
+import hashlib
 import os
 import syslog
 import logging
@@ -7,12 +8,24 @@ import subprocess
 
 from shutil import rmtree
 from tempfile import mkdtemp
+from pragma.repository.cache import CacheManager, ImageCache, MetadataCache
+from pragma.repository.delta import BlockManifest, DeltaUpdate
+from pragma.repository.space import SpacePlan, allocated
+from pragma.repository.downloader import Downloader, DownloadError, SegmentedDownload, readahead
+from pragma.repository.processor import load_processors
 from pragma.repository.processor.fileprocessor import FileProcessor
+from pragma.repository.processor.inflate import InflateError
+from pragma.repository.processor.manifest import ImageManifest
+from pragma.repository.processor.stats import BootRecord
+from pragma.repository.processor.threads import THREAD_CAP
 from pragma.repository.processor.xmlprocessor import XmlInput, XmlOutput
 
 
 class BaseRepository(object):
 
+    # revalidate downloaded vcdb and cluster xml files with repository_url
+    REVALIDATE_METADATA = True
+
     def __init__(self, settings={}):
         self.settings = settings
 
@@ -21,6 +34,8 @@ class BaseRepository(object):
         self.xmlin      = {}   # format {'vmname': XmlInput object derived from cluster.xml file }
         self.xmlout     = None # XmlOutput object 
         self.stagingDir = None # directory for staging images
+        self.record     = BootRecord() # throughput of the image stages of a boot
+        self.unverified = set() # images without manifest that don't match their sha256
 
         self.initRepo()
 
@@ -44,6 +59,69 @@ class BaseRepository(object):
         except KeyError:
             self.vcdbFilename = 'vcdb.txt' 
 
+        # number of image files downloaded at the same time
+        try:
+            self.download_concurrency = int(self.settings["download_concurrency"])
+        except KeyError:
+            self.download_concurrency = 4
+        except ValueError:
+            self.abort('Check repository_settings{} in configuration file. \"download_concurrency\" must be an integer.')
+
+        # native downloader for http(s) and file urls
+        try:
+            retries = int(self.settings.get("download_retries", 5))
+        except ValueError:
+            self.abort('Check repository_settings{} in configuration file. \"download_retries\" must be an integer.')
+        # large files are fetched as several byte range segments at once
+        try:
+            segments = int(self.settings.get("download_segments", 4))
+            min_segment_size = int(self.settings.get("download_min_segment_size", 64 * 1024 * 1024))
+        except ValueError:
+            self.abort('Check repository_settings{} in configuration file. \"download_segments\" and \"download_min_segment_size\" must be integers.')
+        self.downloader = Downloader(retries=retries, segments=segments,
+            min_segment_size=min_segment_size)
+
+        # assemble splited images while their parts are downloaded
+        self.stream_images = bool(self.settings.get("stream_images", False))
+        # keep a copy of streamed parts in repository_dir
+        self.cache_parts = bool(self.settings.get("cache_parts", False))
+
+        # decompression threads of all images processed at the same time
+        try:
+            THREAD_CAP.setThreads(int(self.settings.get("decompress_threads", 0)))
+        except ValueError:
+            self.abort('Check repository_settings{} in configuration file. \"decompress_threads\" must be an integer.')
+
+        # site processor modules adding image file types
+        load_processors(self.settings.get("processor_modules", []))
+
+        # content addressed store of checksum verified images
+        self.cache = ImageCache(os.path.join(self.repo, ".blobs"))
+        # patch outdated images with the blocks that changed when the
+        # repository publishes block manifests
+        self.delta_updates = bool(self.settings.get("delta_updates", True))
+        # optional sha256sum style manifest in each virtual cluster directory
+        self.checksum_manifest = self.settings.get("checksum_manifest")
+
+        # least recently used images are evicted to keep the repository
+        # under cache_max_size bytes, except cache_pinned virtual clusters
+        max_size = self.settings.get("cache_max_size")
+        if max_size is not None:
+            try:
+                max_size = int(max_size)
+            except ValueError:
+                self.abort('Check repository_settings{} in configuration file. \"cache_max_size\" must be an integer.')
+        self.cacheManager = CacheManager(self.repo, max_size,
+            self.settings.get("cache_pinned", []))
+
+        # seconds before the vcdb and cluster xml files are checked for
+        # changes in the remote repository
+        try:
+            self.metadata_ttl = int(self.settings.get("metadata_ttl", 3600))
+        except ValueError:
+            self.abort('Check repository_settings{} in configuration file. \"metadata_ttl\" must be an integer.')
+        self.metadata = MetadataCache(self.repo)
+
 	logging.basicConfig()
 	self.logger = logging.getLogger(self.__module__)
 
@@ -56,6 +134,8 @@ class BaseRepository(object):
         """ rm temp files and directories """
         # delete temp stating directory 
         self.rmStagingDir()
+        # close kept-alive repository connections
+        self.downloader.close()
 
     def setStagingDir(self, path):
         """ create a unique temporary directory for staging virtual images """
@@ -84,33 +164,26 @@ class BaseRepository(object):
         """ Returns a sorted array of available virtual images names"""
         return  sorted(self.vcdb.keys())
 
-    def download(self, rpath, lpath):
+    def download(self, rpath, lpath, digest=None):
         """
-        Download file from remote path to local path
-        Using wget and curl because urllib and urllib2 don't seem to be able
-        to complete big file transfers (at least from Google drive)
+        Download file from remote path to local path with the native
+        downloader. It keeps connections to the repository alive between
+        files, resumes interrupted transfers and checks the file size and
+        the sha256 digest if one is given.
         """
+        if not Downloader.supports(rpath):
+            self.abort('Cannot download %s. Supported repository urls are http://, https:// and file://' % rpath)
+
         # Create directories if neccesary
         local_dir = os.path.dirname(lpath)
         if not os.path.exists(local_dir):
             os.makedirs(local_dir)
 
-        # FIXME redo to put all loggin to a single log file for the command
-        log = "/tmp/pragma_boot.download.log"
-
-        wget = pragma.utils.which("wget")
-        if wget : # using wget 
-            subprocess.check_call([wget, "--append-output=%s" % log, "-S", "-O", lpath, rpath])
-        else:     # using curl 
-            curl = pragma.utils.which("curl")
-            if curl is None:
-                self.abort ('Cannot find wget or curl for downloading files.')
-            subprocess.check_call("%s --retry 5 -L --stderr - -o %s %s 2>&1  1>>%s" % (curl, lpath, rpath, log), shell=True)
-
-        self.logger.info("Downloading %s to %s ... See %s for details" % (rpath, lpath, log))
-
-        if not os.path.isfile(lpath):
-            self.abort ('Error downloading %s. See %s for details' % (lpath, log))
+        self.logger.info("Downloading %s to %s ..." % (rpath, lpath))
+        try:
+            self.downloader.fetch(rpath, lpath, digest)
+        except (DownloadError, OSError) as e:
+            self.abort('Error downloading %s. %s' % (lpath, e))
 
     def getLocalFilePath(self, fname):
         """ returns full path to a file in a local repository """
@@ -123,21 +196,99 @@ class BaseRepository(object):
         except AttributeError:
            self.abort ('Missing repository_url in configuration file.')
 
+    def downloadMetadata(self, fname, lpath):
+        """ download a vcdb or cluster xml file and record its validators """
+        rpath = self.getRemoteFilePath(fname)
+        if not Downloader.supports(rpath):
+            self.abort('Cannot download %s. Supported repository urls are http://, https:// and file://' % rpath)
+        local_dir = os.path.dirname(lpath)
+        if not os.path.exists(local_dir):
+            os.makedirs(local_dir)
+
+        self.logger.info("Downloading %s to %s ..." % (rpath, lpath))
+        try:
+            changed, validators = self.downloader.fetchIfChanged(rpath, lpath)
+        except (DownloadError, OSError) as e:
+            self.abort('Error downloading %s. %s' % (lpath, e))
+        self.metadata.set(lpath, validators)
+
+    def revalidateMetadata(self, fname, lpath):
+        """
+        Check if a downloaded vcdb or cluster xml file changed in the remote
+        repository when it was last checked more than metadata_ttl seconds
+        ago. Unchanged files cost one conditional request.
+
+        :return: Path of a temporary file with the new content or None
+        """
+        if not self.REVALIDATE_METADATA:
+            return None
+        url = getattr(self, 'repository_url', None)
+        if url is None or not Downloader.supports(url):
+            return None
+        if self.metadata.isFresh(lpath, self.metadata_ttl):
+            return None
+
+        new = "%s.new-%s" % (lpath, ImageCache.tmpSuffix())
+        rpath = self.getRemoteFilePath(fname)
+        try:
+            changed, validators = self.downloader.fetchIfChanged(rpath, new,
+                self.metadata.get(lpath))
+        except (DownloadError, OSError) as e:
+            self.logger.warning("Unable to check %s for changes, using local copy. %s" % (lpath, e))
+            return None
+        self.metadata.set(lpath, validators)
+        if not changed:
+            return None
+        self.logger.info("%s changed in the repository" % lpath)
+        return new
+
     def checkVcdbFile (self):
         """ check if the vcdb file exists, download if needed """
         self.vcdbFile = self.getLocalFilePath(self.vcdbFilename)
         if not os.path.isfile(self.vcdbFile):
             self.logger.warning("Missing %s file. Trying to download from repository url defined in configuration file." % self.vcdbFile)
-            rpath = self.getRemoteFilePath(self.vcdbFilename)
-            self.download(rpath, self.vcdbFile)
+            self.downloadMetadata(self.vcdbFilename, self.vcdbFile)
+        else:
+            new = self.revalidateMetadata(self.vcdbFilename, self.vcdbFile)
+            if new is not None:
+                self.mergeVcdb(new)
 
         self.readVcdb()
 
-    def readVcdb(self):
-        with open(self.vcdbFile, 'r') as vcdbFile:
+    @staticmethod
+    def parseVcdb(path):
+        """ returns list of (name, path) entries of a vcdb file """
+        entries = []
+        with open(path, 'r') as vcdbFile:
             for line in vcdbFile:
-                name, path = line.strip().split(',')
-                self.vcdb[name] = self.getLocalFilePath(path)
+                line = line.strip()
+                if not line:
+                    continue
+                name, xml = line.split(',')
+                entries.append((name, xml))
+        return entries
+
+    def mergeVcdb(self, new):
+        """
+        Replace the vcdb file with the entries of the new vcdb file from
+        the repository followed by the local entries it doesn't have. The
+        merged file is renamed into place so readers never see a partial
+        vcdb.
+        """
+        entries = self.parseVcdb(new)
+        names = set([name for name, xml in entries])
+        for name, xml in self.parseVcdb(self.vcdbFile):
+            if name not in names:
+                entries.append((name, xml))
+        with open(new, 'w') as vcdbFile:
+            for name, xml in entries:
+                vcdbFile.write("%s,%s\n" % (name, xml))
+        os.rename(new, self.vcdbFile)
+        self.logger.info("Updated %s" % self.vcdbFile)
+
+    def readVcdb(self):
+        for name, path in self.parseVcdb(self.vcdbFile):
+            self.vcdb[name] = self.getLocalFilePath(path)
 
     def writeVcdb(self):
         with open(self.vcdbFile, 'w') as vcdbFile:
@@ -147,11 +298,15 @@ class BaseRepository(object):
 
     def getVmXmlTree(self, name):
         """Returns an xmltree object corrsponding to a parsed xml file for a VM 'name'"""
-        # download cluster xml description file
-        if not os.path.isfile(self.vcdb[name]):
-            rpath = self.getRemoteFilePath(os.path.basename(self.vcdb[name]))
-            lpath = self.vcdb[name]
-            self.download(rpath, lpath)
+        # download cluster xml description file, or update it if it changed
+        fname = os.path.basename(self.vcdb[name])
+        lpath = self.vcdb[name]
+        if not os.path.isfile(lpath):
+            self.downloadMetadata(fname, lpath)
+        else:
+            new = self.revalidateMetadata(fname, lpath)
+            if new is not None:
+                os.rename(new, lpath)
 
         return ET.parse(self.vcdb[name])
 
@@ -164,19 +319,424 @@ class BaseRepository(object):
         if arch != "x86_64":
             self.abort("Unsupported VM architecture '%s' for virtual image %s" % (arch, name))
 
+        if self.checksum_manifest:
+            self.xmlin[name].addDigests(self.readChecksumManifest(name))
+
+    def readChecksumManifest(self, vcname):
+        """
+        Returns a dictionary of file names and sha256 checksums read from
+        the checksum_manifest file of a virtual cluster, downloading it if
+        needed. The file has the format of sha256sum output.
+        """
+        fname = os.path.join(vcname, self.checksum_manifest)
+        lpath = self.getLocalFilePath(fname)
+        if not os.path.isfile(lpath):
+            url = getattr(self, 'repository_url', None)
+            if url is None or not Downloader.supports(url):
+                return {}
+            try:
+                self.downloader.fetch(self.getRemoteFilePath(fname), lpath)
+            except (DownloadError, OSError) as e:
+                self.logger.warning("No checksum manifest for %s. %s" % (vcname, e))
+                return {}
+
+        digests = {}
+        with open(lpath, 'r') as f:
+            for line in f:
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    continue
+                name = fields[1].strip().lstrip('*')
+                digests[os.path.basename(name)] = fields[0].lower()
+        return digests
+
     def getXmlInputObject(self, name):
         """ returns an xml input object for a VM identified by name """
         return self.xmlin[name]
 
     def downloadImage(self, vcname):
         """Download all files specified in virtual cluster definition """
+        self.downloadFiles(*self.getDownloads(vcname))
+
+    def getImageFiles(self, vcname):
+        """
+        Returns the files images of a virtual cluster are built from, as a
+        list of (file name, local path, sha256 or None, node type) tuples.
+        Parts of streamed images are fetched during processing and parts
+        of images that are cached or processed already are not needed.
+        """
         vmXmlObject = self.xmlin[vcname]
         names = vmXmlObject.getImageNames()
-        for filename in names:
-            lpath = self.getLocalFilePath(os.path.join(vcname, filename))
-            if not os.path.isfile(lpath):
-                rpath = self.getRemoteFilePath(lpath)
-                self.download(rpath, lpath)
+        digests = vmXmlObject.getImageDigests()
+        diskinfo = vmXmlObject.getDiskInfo()
+        skipped = self.getStreamedNodes(vcname) + self.getCachedNodes(vcname) + \
+            self.getProcessedNodes(vcname)
+        for node in set(skipped):
+            for part in diskinfo[node]['parts']:
+                names.remove(part)
+        # node types of the files, for the boot record
+        file_nodes = {}
+        for node in diskinfo.keys():
+            for filename in diskinfo[node]['parts'] or [diskinfo[node].get('file')]:
+                file_nodes[filename] = node
+        return [(filename, self.getLocalFilePath(os.path.join(vcname, filename)),
+            digests.get(filename), file_nodes.get(filename)) for filename in names]
+
+    def getDownloads(self, vcname):
+        """
+        Returns the files of a virtual cluster to download as a tuple
+        (downloads, digests, nodes) of the arguments of downloadFiles.
+        Files on disk were verified by linkCachedImages.
+        """
+        downloads = []
+        download_digests = {}
+        download_nodes = {}
+        for filename, lpath, digest, node in self.getImageFiles(vcname):
+            if os.path.isfile(lpath):
+                continue
+            rpath = self.getRemoteFilePath(os.path.join(vcname, filename))
+            downloads.append((rpath, lpath))
+            if digest is not None:
+                download_digests[lpath] = digest
+            download_nodes[lpath] = node
+        return downloads, download_digests, download_nodes
+
+    def downloadParts(self, vcname, node):
+        """
+        Download the parts of the image of node that are not on disk, e.g.
+        when streaming it failed, linking the ones found in the image cache
+        """
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        downloads = []
+        digests = {}
+        for part in diskinfo[node]['parts']:
+            lpath = self.getLocalFilePath(os.path.join(vcname, part))
+            digest = diskinfo[node]['digests'].get(part)
+            if os.path.isfile(lpath):
+                continue
+            if digest is not None and self.cache.has(digest):
+                self.cache.link(digest, lpath)
+                continue
+            downloads.append((self.getRemoteFilePath(os.path.join(vcname, part)), lpath))
+            if digest is not None:
+                digests[lpath] = digest
+        self.downloadFiles(downloads, digests, dict.fromkeys([lpath for rpath, lpath in downloads], node))
+
+    def downloadFiles(self, downloads, digests={}, nodes={}):
+        """
+        Download a list of (remote path, local path) tuples using up to
+        download_concurrency simultaneous transfers. All transfers are
+        attempted and failures are reported together. Files with an
+        expected sha256 in digests (keys are local paths) are verified as
+        they are downloaded, fetched again on mismatch and added to the
+        image cache. Transfers are added to the boot record as fetch
+        stages of the node types in nodes (keys are local paths).
+        """
+        if not downloads:
+            return
+
+        # create directories up front so workers don't race on them
+        for rpath, lpath in downloads:
+            local_dir = os.path.dirname(lpath)
+            if not os.path.exists(local_dir):
+                os.makedirs(local_dir)
+
+        def fetch(download):
+            rpath, lpath = download
+            # the digest is checked while downloading, no need to read it again
+            with self.record.stage("fetch", lpath, nodes.get(lpath)) as stage:
+                self.download(rpath, lpath, digests.get(lpath))
+                stage.bytes_in = stage.bytes_out = os.path.getsize(lpath)
+            if lpath in digests:
+                self.cache.add(lpath, digests[lpath])
+
+        self.logger.info("Downloading %d files with %d concurrent transfers" % 
+            (len(downloads), min(self.download_concurrency, len(downloads))))
+        results, errors = pragma.utils.parallel_map(
+            fetch, downloads, self.download_concurrency)
+
+        if errors:
+            msg = ["Failed to download %d of %d files:" % (len(errors), len(downloads))]
+            for rpath, lpath in sorted(errors.keys()):
+                msg.append("  %s: %s" % (lpath, errors[(rpath, lpath)]))
+            self.abort("\n".join(msg))
+
+    def getCachedNodes(self, vcname):
+        """
+        Returns node types whose image file has a sha256 checksum and is a
+        link to a verified blob in the image cache, so it needs no download
+        or processing.
+        """
+        nodes = []
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        for node in diskinfo.keys():
+            digest = diskinfo[node]['sha256']
+            if not digest or not diskinfo[node]['parts']:
+                continue
+            if self.cache.isLinked(self.getLocalFilePath(diskinfo[node]['file']), digest):
+                nodes.append(node)
+        return nodes
+
+    def linkCachedImages(self, vcname):
+        """
+        Link image files that are missing but found in the image cache and
+        verify assembled images that are not in the image cache yet, then
+        do the same for the files the other images are built from. Files
+        that don't match their checksum are removed.
+        """
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        for node in diskinfo.keys():
+            digest = diskinfo[node]['sha256']
+            lpath = self.getLocalFilePath(diskinfo[node]['file'])
+            if not digest or not diskinfo[node]['parts']:
+                continue
+            if os.path.isfile(lpath) and not self.cache.verify(lpath, digest):
+                self.logger.warning("Removing corrupted or stale image %s" % lpath)
+                os.remove(lpath)
+            if not os.path.exists(lpath) and self.cache.has(digest):
+                self.logger.info("Using cached %s image %s" % (node, digest))
+                local_dir = os.path.dirname(lpath)
+                if not os.path.exists(local_dir):
+                    os.makedirs(local_dir)
+                self.cache.link(digest, lpath)
+
+        for filename, lpath, digest, node in self.getImageFiles(vcname):
+            if digest is None:
+                continue
+            if os.path.isfile(lpath) and not self.cache.verify(lpath, digest):
+                self.logger.warning("Removing corrupted or stale file %s" % lpath)
+                os.remove(lpath)
+            if not os.path.exists(lpath) and self.cache.has(digest):
+                local_dir = os.path.dirname(lpath)
+                if not os.path.exists(local_dir):
+                    os.makedirs(local_dir)
+                self.cache.link(digest, lpath)
+
+    def getProcessedNodes(self, vcname):
+        """
+        Returns node types whose image was already assembled from the parts
+        listed in the cluster xml description and is unchanged since, so
+        it needs no download or processing.
+        """
+        nodes = []
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        for node in diskinfo.keys():
+            parts = diskinfo[node]['parts']
+            if not parts:
+                continue
+            lpath = self.getLocalFilePath(diskinfo[node]['file'])
+            manifest = ImageManifest(lpath)
+            if manifest.isValid(diskinfo[node]['type'], parts, diskinfo[node]['digests']):
+                nodes.append(node)
+                continue
+            # image processed before manifests were recorded, adopted only
+            # if it matches the sha256 checksum of the cluster xml since
+            # the parts may have changed
+            digest = diskinfo[node]['sha256']
+            if not digest or lpath in self.unverified or not os.path.isfile(lpath) or \
+                    manifest.read() is not None:
+                continue
+            if self.cache.verify(lpath, digest):
+                self.logger.info("Recording manifest of processed image %s" % lpath)
+                manifest.write(diskinfo[node]['type'], parts, {}, diskinfo[node]['digests'])
+                nodes.append(node)
+            else:
+                self.unverified.add(lpath)
+        return nodes
+
+    def updateImages(self, vcname):
+        """
+        Update outdated local images in place with the blocks that changed,
+        when the repository publishes a block manifest '<image>.blocks'.
+        An image is outdated when it exists but doesn't match its sha256
+        checksum or the parts it was processed from, and the new version is
+        not in the image cache. The checksum is computed in the same pass
+        as the checksums of the blocks, so an image is read once to find
+        whether and where it changed. Images without a manifest, or whose
+        update fails, are downloaded in full.
+        """
+        if not self.delta_updates:
+            return
+        url = getattr(self, 'repository_url', None)
+        if url is None or not Downloader.supports(url):
+            return
+
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        current = self.getCachedNodes(vcname) + self.getProcessedNodes(vcname)
+        images = {}
+        for node in diskinfo.keys():
+            if node in current or 'file' not in diskinfo[node]:
+                continue
+            file = self.getLocalFilePath(diskinfo[node]['file'])
+            if not os.path.isfile(file) or file in images:
+                continue
+            digest = diskinfo[node]['sha256']
+            if digest and self.cache.has(digest):
+                continue
+            if not diskinfo[node]['parts'] and not digest:
+                continue
+            images[file] = node
+
+        for file, node in images.items():
+            info = diskinfo[node]
+            rpath = self.getRemoteFilePath(info['file'] + BlockManifest.SUFFIX)
+            lpath = file + BlockManifest.SUFFIX
+            try:
+                self.downloader.fetch(rpath, lpath)
+                manifest = BlockManifest.load(lpath)
+            except (DownloadError, ValueError) as e:
+                self.logger.info("No block manifest for %s, downloading it in full. %s" % (file, e))
+                continue
+            finally:
+                if os.path.isfile(lpath):
+                    os.remove(lpath)
+
+            source = os.path.join(os.path.dirname(info['file']),
+                manifest.source or os.path.basename(info['file']))
+            update = DeltaUpdate(self.downloader, manifest,
+                self.getRemoteFilePath(source), self.download_concurrency)
+            ImageManifest(file).remove()
+            try:
+                with self.record.stage("delta", file, node) as stage:
+                    stage.bytes_out = manifest.size
+                    result = update.apply(file, info['sha256'])
+                    stage.bytes_in = result['bytes']
+            except (DownloadError, IOError, ValueError) as e:
+                self.logger.warning("Delta update of %s failed, downloading it in full. %s" % (file, e))
+                os.remove(file)
+                continue
+            if result['current']:
+                self.cache.add(file, info['sha256'])
+            elif info['sha256'] and not self.cache.verify(file, info['sha256']):
+                self.logger.warning("Delta update of %s doesn't match its checksum, downloading it in full" % file)
+                os.remove(file)
+                continue
+            if info['parts']:
+                ImageManifest(file).write(info['type'], info['parts'], {}, info['digests'])
+
+    def checkSpace(self, vcname, ready, streamed, downloads):
+        """
+        Make room for the files a boot is about to write and abort before
+        writing anything if they don't fit in repository_dir: downloads
+        (sized with HEAD requests), assembled images (the size declared in
+        the cluster xml, else the sum of the parts for splited images).
+
+        :param ready: Node types whose image needs no download or processing
+        :param streamed: Node types whose image is assembled while downloaded
+        :param downloads: List of (remote path, local path) files to download
+        """
+        plan = SpacePlan(self.repo)
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        part_sizes = {}
+        for rpath, lpath in downloads:
+            size = self.downloader.size(rpath)
+            if size is not None:
+                # interrupted downloads are resumed
+                size -= allocated(lpath + Downloader.PARTIAL_SUFFIX)
+            part_sizes[lpath] = size
+            plan.add("download of %s" % lpath, size)
+
+        base_dir = os.path.dirname(os.path.join(self.repo, self.vcdb[vcname]))
+        for node in diskinfo.keys():
+            if node in ready or not diskinfo[node]['parts']:
+                continue
+            file = self.getLocalFilePath(diskinfo[node]['file'])
+            sizes = []
+            for name in diskinfo[node]['parts']:
+                part = os.path.join(base_dir, name)
+                if part in part_sizes:
+                    sizes.append(part_sizes[part])
+                elif os.path.isfile(part):
+                    sizes.append(os.path.getsize(part))
+                elif node in streamed:
+                    sizes.append(self.downloader.size(
+                        self.getRemoteFilePath(os.path.join(vcname, name))))
+                    if self.cache_parts:
+                        plan.add("cached part %s" % part, sizes[-1])
+                else:
+                    sizes.append(None)
+            size = diskinfo[node]['size']
+            if size is None and diskinfo[node]['type'] == 'splited' and None not in sizes:
+                size = sum(sizes)
+            if size is not None:
+                # the outdated image is overwritten
+                size -= allocated(file)
+            plan.add("%s image %s" % (node, file), size)
+
+        self.evictCache(keep=[vcname], needed=plan.needed())
+        error = plan.check()
+        if error:
+            self.abort(error)
+
+    def getStreamedNodes(self, vcname):
+        """
+        Returns node types whose image is assembled while its parts are
+        downloaded: stream_images is set, the image type is streamable, the
+        image is not assembled yet and the repository url can be read by the
+        native downloader.
+        """
+        if not self.stream_images:
+            return []
+        url = getattr(self, 'repository_url', None)
+        if url is None or not Downloader.supports(url):
+            return []
+
+        nodes = []
+        diskinfo = self.xmlin[vcname].getDiskInfo()
+        for node in diskinfo.keys():
+            type = diskinfo[node].get('type')
+            if not type or not FileProcessor.isStreamable(type):
+                continue
+            if os.path.isfile(os.path.join(self.repo, diskinfo[node]['file'])):
+                continue
+            nodes.append(node)
+        return nodes
+
+    def streamParts(self, vcname, base_dir, parts):
+        """
+        Generator returning the content of image parts in order. Parts that
+        are already on disk are read from there, the others are downloaded
+        and only written to disk if cache_parts is set. Downloaded parts
+        with a sha256 checksum are hashed as they stream by.
+        """
+        digests = self.xmlin[vcname].getImageDigests()
+        for part in parts:
+            lpath = os.path.join(base_dir, part)
+            digest = digests.get(part)
+            if not os.path.isfile(lpath) and digest is not None and self.cache.has(digest):
+                lpath = self.cache.blobPath(digest)
+            if os.path.isfile(lpath):
+                self.logger.info("Reading cached part %s" % lpath)
+                chunks = self.downloader.iterate("file://" + os.path.abspath(lpath))
+                for data in chunks:
+                    yield data
+                continue
+
+            rpath = self.getRemoteFilePath(os.path.join(vcname, part))
+            self.logger.info("Streaming %s ..." % rpath)
+            cache = None
+            if self.cache_parts:
+                cache = open(lpath + Downloader.PARTIAL_SUFFIX, 'wb')
+            sha = hashlib.sha256()
+            try:
+                for data in self.downloader.iterate(rpath):
+                    if cache:
+                        cache.write(data)
+                    sha.update(data)
+                    yield data
+                if digest is not None and sha.hexdigest() != digest:
+                    raise DownloadError("%s: sha256 checksum mismatch" % rpath)
+            except:
+                # also when the consumer stopped early
+                if cache:
+                    cache.close()
+                    os.remove(lpath + Downloader.PARTIAL_SUFFIX)
+                raise
+            if cache:
+                cache.close()
+                os.rename(lpath + Downloader.PARTIAL_SUFFIX, lpath)
+                if digest is not None:
+                    self.cache.add(lpath, digest)
 
     def processCluster(self, name, path):
 
@@ -190,37 +750,169 @@ class BaseRepository(object):
         # and create xml input object from it
         self.createXmlInputObject(name)
 
-        # download cluster images
-        self.downloadImage(name)
+        # record use of this virtual cluster; room for its images is made
+        # by checkSpace
+        self.cacheManager.touch(name)
+
+        # stages of getting the images ready are recorded even if one fails
+        self.record = BootRecord(name)
+        try:
+            self.prepareImages(name)
+        finally:
+            self.writeRecord()
+
+        # create xml output object
+        if path is not None:
+            self.createXmlOutputObject(path)
+
+        return
+
+    def prepareImages(self, name):
+        """ download and process the images of virtual cluster name """
+        # patch outdated images with the changed blocks, link images found
+        # in the image cache and download the others
+        self.updateImages(name)
+        self.linkCachedImages(name)
+        cached = self.getCachedNodes(name)
+        processed = self.getProcessedNodes(name)
+        streamed = self.getStreamedNodes(name)
+        downloads = self.getDownloads(name)
+        self.checkSpace(name, cached + processed, streamed, downloads[0])
+        self.downloadFiles(*downloads)
 
         # process cluster images if needed
         base_dir = os.path.dirname(os.path.join(self.repo, self.vcdb[name]))
         vmXmlObject = self.xmlin[name]
 
 	diskinfo = vmXmlObject.getDiskInfo()
+        nodes = []
         for node in diskinfo.keys():
+            if node in cached or node in processed:
+                self.logger.info("Using processed %s image" % node)
+            else:
+                nodes.append(node)
+
+        # frontend and compute images are processed at the same time,
+        # external decompressors get an equal share of decompress_threads
+        threads = THREAD_CAP.share(len(nodes))
+
+        def processNode(node):
             parts = diskinfo[node]['parts']
             type = diskinfo[node]['type']
             file = os.path.join(self.repo,diskinfo[node]['file'])
-            fp = FileProcessor(base_dir, file, parts, type)
-            fp.process()
-
-        # create xml output object
-        if path is not None:
-            self.createXmlOutputObject(path)
-
-        return
+            manifest = ImageManifest(file)
+            manifest.remove()
+            fp = FileProcessor(base_dir, file, parts, type, threads, self.record, node)
+            stream = node in streamed
+            if stream:
+                chunks = readahead(self.streamParts(name, base_dir, parts))
+                try:
+                    fp.stream(chunks)
+                except (DownloadError, InflateError, subprocess.CalledProcessError) as e:
+                    self.logger.warning("Error streaming %s image %s, downloading its parts instead. %s" % (
+                        node, file, e))
+                    stream = False
+                finally:
+                    chunks.close()
+                if not stream:
+                    # parts failing their checksum are fetched again
+                    self.downloadParts(name, node)
+            # parts are deleted once processed, measure them first
+            sizes = {}
+            for part in parts:
+                if os.path.isfile(os.path.join(base_dir, part)):
+                    sizes[part] = os.path.getsize(os.path.join(base_dir, part))
+            if not stream:
+                fp.process()
+
+            # keep assembled image in the image cache
+            digest = diskinfo[node]['sha256']
+            if digest and parts:
+                with self.record.stage("verify", file, node) as stage:
+                    stage.bytes_in = os.path.getsize(file)
+                    verified = self.cache.verify(file, digest)
+                if not verified:
+                    self.abort('Checksum mismatch for %s image %s' % (node, file))
+            if parts:
+                manifest.write(type, parts, sizes, diskinfo[node]['digests'])
+
+        if nodes:
+            self.logger.info("Processing %d images with %d decompression threads" %
+                (len(nodes), THREAD_CAP.threads))
+        results, errors = pragma.utils.parallel_map(processNode, nodes, len(nodes))
+        if errors:
+            msg = ["Failed to process %d of %d images:" % (len(errors), len(nodes))]
+            for node in sorted(errors.keys()):
+                msg.append("  %s: %s" % (node, errors[node]))
+            self.abort("\n".join(msg))
+
+    def writeRecord(self):
+        """ append the boot record to repository_dir/.boots """
+        try:
+            self.record.write(os.path.join(self.repo, BootRecord.FILENAME))
+        except IOError as e:
+            self.logger.warning("Unable to write boot record. %s" % e)
 
     def is_downloaded(self):
         raise NotImplementedError
 
+    def isEvictable(self):
+        """ returns True if deleted images can be downloaded again """
+        return getattr(self, 'repository_url', None) is not None
+
+    def evictCache(self, keep=[], needed=0):
+        """
+        delete least recently used images if the repository is over budget
+        or needed bytes are not free on its filesystem
+        """
+        if not self.isEvictable():
+            return []
+        return self.cacheManager.evict(self.listRepository(), self.delete_vc,
+            keep, needed)
+
+    def getImagePaths(self, vcname):
+        """
+        Returns paths of all image files of a virtual cluster in the repository.
+        Only the local cluster xml is read, it is not revalidated or downloaded.
+        """
+        base_dir = os.path.dirname(self.vcdb[vcname])
+        vmXmlObject = XmlInput(ET.parse(self.vcdb[vcname]), base_dir)
+        paths = set()
+        for filename in vmXmlObject.getImageNames():
+            paths.add(self.getLocalFilePath(os.path.join(vcname, filename)))
+            paths.add(os.path.join(base_dir, filename))
+        diskinfo = vmXmlObject.getDiskInfo()
+        for node in diskinfo.keys():
+            if 'file' in diskinfo[node]:
+                paths.add(self.getLocalFilePath(diskinfo[node]['file']))
+        return sorted(paths)
+
     def delete_vc(self, vcname):
         """Delete VC from repository cache if exists"""
-        raise NotImplementedError
+        if vcname not in self.vcdb:
+            self.abort('Virtual image %s does not exist.' % vcname)
+        if not self.isEvictable():
+            self.abort('Images of %s cannot be deleted, there is no repository_url to download them again.' % vcname)
+
+        if os.path.isfile(self.vcdb[vcname]):
+            for path in self.getImagePaths(vcname):
+                for suffix in ("", Downloader.PARTIAL_SUFFIX, Downloader.PARTIAL_SUFFIX + SegmentedDownload.STATE_SUFFIX,
+                               ImageManifest.SUFFIX, BlockManifest.SUFFIX):
+                    if os.path.isfile(path + suffix):
+                        self.logger.info("Removing %s" % (path + suffix))
+                        os.remove(path + suffix)
+        self.cacheManager.forget(vcname)
+        self.cache.prune()
 
     def clear_cache(self):
         """Clear repository cache entirely"""
-        raise NotImplementedError
+        if not self.isEvictable():
+            self.abort('Images cannot be deleted, there is no repository_url to download them again.')
+        for vcname in self.listRepository():
+            if vcname in self.cacheManager.pinned:
+                self.logger.info("Keeping pinned virtual image %s" % vcname)
+                continue
+            self.delete_vc(vcname)
 
     def sync(self):
         """Sync local repository to its remote one """
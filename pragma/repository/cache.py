@@ -0,0 +1,309 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from pragma.repository.space import freeSpace
+
+logger = logging.getLogger('pragma.repository.cache')
+
+
+class ImageCache(object):
+    """
+    Content addressed store of verified image files.
+
+    Files are stored once under <store_dir>/sha256/<xx>/<digest> after their
+    sha256 digest has been checked, and virtual cluster paths are hardlinks
+    (or reflinks when the store is on another filesystem) to the stored
+    blob. A path that already shares its inode with a blob is trusted
+    without reading it again, so each blob is verified only once.
+    """
+    HASH_CHUNK = 1024 * 1024
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def blobPath(self, digest):
+        """ returns path of the blob for a sha256 digest """
+        digest = digest.lower()
+        return os.path.join(self.store_dir, "sha256", digest[:2], digest)
+
+    def has(self, digest):
+        """ returns True if a verified blob exists for digest """
+        return os.path.isfile(self.blobPath(digest))
+
+    def isLinked(self, path, digest):
+        """ returns True if path is a link to the blob of digest """
+        try:
+            return os.path.samefile(path, self.blobPath(digest))
+        except OSError:
+            return False
+
+    @staticmethod
+    def hashFile(path):
+        """ returns sha256 hex digest of a file """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(ImageCache.HASH_CHUNK)
+                if not data:
+                    break
+                sha.update(data)
+        return sha.hexdigest()
+
+    def verify(self, path, digest):
+        """
+        Check path against digest and add it to the store if it matches.
+
+        :param path: Path to a file in the repository
+        :param digest: Expected sha256 hex digest
+        :return: True if the file content matches digest, otherwise False
+        """
+        if self.isLinked(path, digest):
+            return True
+        logger.info("Verifying sha256 checksum of %s ..." % path)
+        actual = self.hashFile(path)
+        if actual != digest.lower():
+            logger.error("Checksum mismatch for %s: expected %s, got %s" % (path, digest, actual))
+            return False
+        self.add(path, digest)
+        return True
+
+    def add(self, path, digest):
+        """
+        Add an already verified file to the store. If the blob already
+        exists path is replaced by a link to it so the content is stored
+        only once.
+        """
+        blob = self.blobPath(digest)
+        blob_dir = os.path.dirname(blob)
+        if not os.path.isdir(blob_dir):
+            try:
+                os.makedirs(blob_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        try:
+            os.link(path, blob)
+            logger.debug("Stored %s as %s" % (path, blob))
+            return
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                pass
+            elif e.errno == errno.EXDEV:
+                self.copy(path, blob)
+                return
+            else:
+                raise
+        # same content already stored, keep a single copy
+        self.link(digest, path)
+
+    def link(self, digest, path):
+        """ create path as a hardlink or reflink to the blob of digest """
+        blob = self.blobPath(digest)
+        tmp = "%s.link-%s" % (path, ImageCache.tmpSuffix())
+        try:
+            os.link(blob, tmp)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            self.copy(blob, tmp)
+        os.rename(tmp, path)
+        logger.debug("Linked %s to %s" % (path, blob))
+
+    @staticmethod
+    def tmpSuffix():
+        """ unique suffix for temporary files of this thread """
+        return "%d-%d" % (os.getpid(), threading.current_thread().ident)
+
+    @staticmethod
+    def copy(src, dest):
+        """ copy across filesystems, sharing blocks when supported """
+        tmp = "%s.copy-%s" % (dest, ImageCache.tmpSuffix())
+        subprocess.check_call(["cp", "--reflink=auto", "--sparse=always", src, tmp])
+        os.rename(tmp, dest)
+
+    def prune(self):
+        """
+        Remove blobs that are no longer linked from any virtual cluster
+
+        :return: Number of bytes freed
+        """
+        freed = 0
+        for path in self.blobs():
+            st = os.stat(path)
+            if st.st_nlink == 1:
+                logger.info("Removing unused blob %s" % path)
+                os.remove(path)
+                freed += st.st_blocks * 512
+        return freed
+
+    def blobs(self):
+        """ returns list of paths of all stored blobs """
+        paths = []
+        for root, dirs, files in os.walk(os.path.join(self.store_dir, "sha256")):
+            for name in files:
+                paths.append(os.path.join(root, name))
+        return paths
+
+
+class CacheManager(object):
+    """
+    Keeps the local repository within a byte budget and makes room for
+    new images on its filesystem.
+
+    The last time each virtual cluster was used is recorded in
+    <repository_dir>/.usage. When the repository grows over max_size, or
+    the filesystem lacks the space new images need, the least recently
+    used virtual clusters are deleted, except the pinned ones and the ones
+    in use.
+    """
+    USAGE_FILENAME = ".usage"
+
+    def __init__(self, repo_dir, max_size=None, pinned=[]):
+        self.repo_dir = repo_dir
+        self.max_size = max_size
+        self.pinned = list(pinned)
+        self.usage_file = os.path.join(repo_dir, self.USAGE_FILENAME)
+
+    def lastUsed(self):
+        """ returns hash array where key is vc name and value is last use time """
+        if not os.path.isfile(self.usage_file):
+            return {}
+        try:
+            with open(self.usage_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Ignoring corrupted %s" % self.usage_file)
+            return {}
+
+    def writeLastUsed(self, usage):
+        tmp = "%s.%s" % (self.usage_file, ImageCache.tmpSuffix())
+        with open(tmp, 'w') as f:
+            json.dump(usage, f)
+        os.rename(tmp, self.usage_file)
+
+    def touch(self, vcname):
+        """ record that vcname is used now """
+        usage = self.lastUsed()
+        usage[vcname] = time.time()
+        self.writeLastUsed(usage)
+
+    def forget(self, vcname):
+        """ remove vcname from the usage record """
+        usage = self.lastUsed()
+        if vcname in usage:
+            del usage[vcname]
+            self.writeLastUsed(usage)
+
+    @staticmethod
+    def diskUsage(path):
+        """ returns bytes allocated by files under path, counting hardlinks once """
+        seen = set()
+        total = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_blocks * 512
+        return total
+
+    def evict(self, vcnames, delete, keep=[], needed=0):
+        """
+        Delete least recently used virtual clusters until the repository
+        plus needed bytes fits in max_size and needed bytes are free on the
+        filesystem of the repository.
+
+        :param vcnames: Names of virtual clusters that can be deleted
+        :param delete: Callable deleting the images of a virtual cluster
+        :param keep: Names of virtual clusters in use
+        :param needed: Bytes that are about to be added to the repository
+        :return: List of deleted virtual cluster names
+        """
+        used = self.diskUsage(self.repo_dir)
+        if not self.isShort(used, needed):
+            return []
+
+        last_used = self.lastUsed()
+        candidates = [vc for vc in vcnames
+            if vc not in self.pinned and vc not in keep]
+        candidates.sort(key=lambda vc: last_used.get(vc, 0))
+
+        evicted = []
+        for vc in candidates:
+            if not self.isShort(used, needed):
+                break
+            logger.info("Repository uses %d bytes with %d bytes needed and %d free, evicting %s" % (
+                used, needed, freeSpace(self.repo_dir), vc))
+            delete(vc)
+            evicted.append(vc)
+            used = self.diskUsage(self.repo_dir)
+
+        if self.max_size is not None and used + needed > self.max_size:
+            logger.warning("Repository uses %d bytes, over its %d bytes budget" % (
+                used + needed, self.max_size))
+        return evicted
+
+    def isShort(self, used, needed):
+        """
+        returns True if used plus needed bytes are over max_size or needed
+        bytes are not free on the filesystem of the repository
+        """
+        if self.max_size is not None and used + needed > self.max_size:
+            return True
+        return needed > freeSpace(self.repo_dir)
+
+
+class MetadataCache(object):
+    """
+    Validators of the vcdb and cluster xml files downloaded from a remote
+    repository, kept in <repository_dir>/.metadata with the time each file
+    was last checked, so the files can be revalidated with conditional
+    requests once they are older than a time to live.
+    """
+    METADATA_FILENAME = ".metadata"
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.metadata_file = os.path.join(repo_dir, self.METADATA_FILENAME)
+
+    def read(self):
+        """ returns hash array where key is a file path relative to the repository """
+        if not os.path.isfile(self.metadata_file):
+            return {}
+        try:
+            with open(self.metadata_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Ignoring corrupted %s" % self.metadata_file)
+            return {}
+
+    def key(self, path):
+        return os.path.relpath(path, self.repo_dir)
+
+    def get(self, path):
+        """ returns the validators recorded for path or {} """
+        return self.read().get(self.key(path), {}).get('validators', {})
+
+    def set(self, path, validators):
+        """ record validators of path and that it was checked now """
+        metadata = self.read()
+        metadata[self.key(path)] = {'validators': validators, 'checked': time.time()}
+        tmp = "%s.%s" % (self.metadata_file, ImageCache.tmpSuffix())
+        with open(tmp, 'w') as f:
+            json.dump(metadata, f)
+        os.rename(tmp, self.metadata_file)
+
+    def isFresh(self, path, ttl):
+        """ returns True if path was checked less than ttl seconds ago """
+        checked = self.read().get(self.key(path), {}).get('checked')
+        return checked is not None and time.time() - checked < ttl
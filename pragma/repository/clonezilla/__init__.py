@@ -14,6 +14,8 @@ import xml.etree.ElementTree as ET
 
 class Repository(pragma.repository.http.Repository):
 	DOWNLOAD_CHUNK_SIZE = 250 * 1024 * 1024
+	# the vcdb and cluster xml files are created locally by sync
+	REVALIDATE_METADATA = False
 
 	def __init__(self, settings):
 		"""
@@ -62,6 +64,10 @@ class Repository(pragma.repository.http.Repository):
 		""" Don't download images """
 		pass
 
+	def getDownloads(self, vcname):
+		""" Images are synced, there is nothing to download """
+		return [], {}, {}
+
 	def listRemoteRepository(self):
 		"""
 		Read the Google drive remote repository.  Each folder in the
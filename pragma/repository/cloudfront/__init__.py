@@ -1,9 +1,14 @@
 import os.path
+import threading
+import time
 from pragma.repository import BaseRepository
 from boto.cloudfront.distribution import Distribution
 
 class Repository(BaseRepository):
 
+    # sign again this many seconds before the signature expires
+    SIGNING_MARGIN = 300
+
     def __init__(self, settings):
         super(Repository, self).__init__(settings)
 
@@ -12,6 +17,9 @@ class Repository(BaseRepository):
 
         # Needed for creating signed url
         self.distribution = Distribution()
+        self.signing_query = None    # query string signing all repository urls
+        self.signing_expires = None  # expiration time of signing_query
+        self.signing_lock = threading.Lock()
         self.checkVcdbFile()
 
     def checkSettings(self):
@@ -31,17 +39,55 @@ class Repository(BaseRepository):
         except KeyError:
             self.abort('Check repository_settings{} in configuration file. Missing  \"private_key_file\".' )
 
+        try:
+            self.signed_url_expiry = int(self.settings.get('signed_url_expiry', 86400))
+        except ValueError:
+            self.abort('Check repository_settings{} in configuration file. \"signed_url_expiry\" must be an integer.' )
+        if self.signed_url_expiry <= 0:
+            self.abort('Check repository_settings{} in configuration file. \"signed_url_expiry\" must be positive.' )
+        # short expiry times would otherwise be within the margin right after signing
+        self.signing_margin = min(self.SIGNING_MARGIN, self.signed_url_expiry // 2)
+
+        # read the private key once
+        try:
+            with open(self.private_key_file, 'r') as f:
+                self.private_key = f.read()
+        except IOError as e:
+            self.abort('Unable to read private_key_file %s. %s' % (self.private_key_file, e))
 
-    def getRemoteFielPath(self, fname):
+    def getRemoteFilePath(self, fname):
         rpath =  os.path.join(self.repository_url, fname)
         rpath =  self.create_signed_url(rpath)
         return rpath
 
     def create_signed_url(self, url):
-        """ Create signed url with no expiration """
-        return self.distribution.create_signed_url(
-            url=url,
-            keypair_id=self.keypair_id,
-            private_key_file=self.private_key_file
-        )
+        """ Create signed url valid for signed_url_expiry seconds """
+        if "?" in url:
+            sep = "&"
+        else:
+            sep = "?"
+        return url + sep + self.getSigningQuery()
 
+    def getSigningQuery(self):
+        """
+        Returns the query string signing every url of the repository. A
+        single custom policy for repository_url/* is signed and reused for
+        all files until it is about to expire, so the RSA signature is
+        computed once per run rather than once per file.
+        """
+        with self.signing_lock:
+            now = time.time()
+            if self.signing_query is None or now > self.signing_expires - self.signing_margin:
+                self.signing_expires = int(now + self.signed_url_expiry)
+                base_url = self.repository_url.rstrip("/")
+                signed = self.distribution.create_signed_url(
+                    url=base_url,
+                    keypair_id=self.keypair_id,
+                    expire_time=self.signing_expires,
+                    policy_url=base_url + "/*",
+                    private_key_string=self.private_key
+                )
+                self.signing_query = signed.split("?", 1)[1]
+                self.logger.debug("Signed %s/* until %s" % (base_url,
+                    time.ctime(self.signing_expires)))
+            return self.signing_query
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+import pragma.utils
+from pragma.repository.cache import ImageCache
+
+logger = logging.getLogger('pragma.repository.delta')
+
+
+class BlockManifest(object):
+    """
+    Block checksum manifest of a published image, '<image>.blocks' next
+    to it in the repository. It is a json object with the image size, the
+    block size, the sha256 checksum of each block and optionally the
+    name of the file, relative to the manifest, holding the uncompressed
+    image data the blocks can be fetched from ('source', defaults to the
+    image name). Publishers create it with:
+
+        python -m pragma.repository.delta <image> [<source>]
+    """
+    SUFFIX = ".blocks"
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, size, block_size, blocks, source=None):
+        self.size = size
+        self.block_size = block_size
+        self.blocks = blocks
+        self.source = source
+
+    @classmethod
+    def load(cls, path):
+        """ returns the manifest read from path, raises ValueError if invalid """
+        with open(path, 'r') as f:
+            try:
+                data = json.load(f)
+                manifest = cls(int(data['size']), int(data['block_size']),
+                    [str(block) for block in data['blocks']], data.get('source'))
+            except (KeyError, TypeError) as e:
+                raise ValueError("%s: invalid block manifest. %s" % (path, e))
+        if manifest.block_size <= 0 or len(manifest.blocks) != \
+                (manifest.size + manifest.block_size - 1) // manifest.block_size:
+            raise ValueError("%s: block count doesn't match the image size" % path)
+        return manifest
+
+    @staticmethod
+    def hashBlocks(path, block_size, sha=None):
+        """
+        returns sha256 checksums of the blocks of the file path, the whole
+        file is added to sha in the same pass when it is given
+        """
+        blocks = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(block_size)
+                if not data:
+                    break
+                blocks.append(hashlib.sha256(data).hexdigest())
+                if sha is not None:
+                    sha.update(data)
+        return blocks
+
+    @classmethod
+    def create(cls, image, source=None, block_size=BLOCK_SIZE):
+        """ write the manifest of image to '<image>.blocks' """
+        manifest = {
+            'size': os.path.getsize(image),
+            'block_size': block_size,
+            'blocks': cls.hashBlocks(image, block_size),
+        }
+        if source is not None:
+            manifest['source'] = source
+        with open(image + cls.SUFFIX, 'w') as f:
+            json.dump(manifest, f)
+        return image + cls.SUFFIX
+
+
+class DeltaUpdate(object):
+    """
+    Update a local copy of an image in place to the version described by
+    a block manifest, fetching only the blocks whose checksum differs with
+    http Range requests. Adjacent changed blocks are fetched together, up
+    to MAX_RANGE bytes per request, with up to concurrency requests at the
+    same time. Each fetched block is checked against the manifest.
+    """
+    MAX_RANGE = 16 * 1024 * 1024
+
+    def __init__(self, downloader, manifest, source_url, concurrency=4):
+        self.downloader = downloader
+        self.manifest = manifest
+        self.source_url = source_url
+        self.concurrency = concurrency
+
+    def ranges(self, changed):
+        """ returns list of (first block, last block) runs of changed blocks """
+        per_range = max(1, self.MAX_RANGE // self.manifest.block_size)
+        runs = []
+        for index in changed:
+            if runs and runs[-1][1] == index - 1 and index - runs[-1][0] < per_range:
+                runs[-1] = (runs[-1][0], index)
+            else:
+                runs.append((index, index))
+        return runs
+
+    def apply(self, image, digest=None):
+        """
+        Patch image to the manifest version
+
+        :param image: Path to the local copy of the image
+        :param digest: Expected sha256 hex digest of the new version or
+            None. The image is hashed with its blocks and left as is if it
+            already matches.
+        :return: Hash array with the number of 'blocks', the number of
+            'changed' blocks, the 'bytes' fetched and whether the image was
+            already 'current'
+        """
+        manifest = self.manifest
+        sha = None
+        if digest:
+            sha = hashlib.sha256()
+        local = BlockManifest.hashBlocks(image, manifest.block_size, sha)
+        if sha is not None and sha.hexdigest() == digest.lower():
+            logger.info("%s is up to date" % image)
+            return {'blocks': len(manifest.blocks), 'changed': 0, 'bytes': 0, 'current': True}
+
+        # the image may be a hardlink to a blob of the image cache, which
+        # must keep its content
+        if os.stat(image).st_nlink > 1:
+            ImageCache.copy(image, image)
+
+        changed = [i for i in range(len(manifest.blocks))
+            if i >= len(local) or local[i] != manifest.blocks[i]]
+        logger.info("%s: %d of %d blocks changed" % (image, len(changed), len(manifest.blocks)))
+
+        fetched = [0]
+        lock = threading.Lock()
+
+        def fetch(run):
+            first, last = run
+            start = first * manifest.block_size
+            end = min((last + 1) * manifest.block_size, manifest.size) - 1
+            data = self.downloader.fetchRange(self.source_url, start, end)
+            for i in range(first, last + 1):
+                offset = (i - first) * manifest.block_size
+                block = data[offset:offset + manifest.block_size]
+                if hashlib.sha256(block).hexdigest() != manifest.blocks[i]:
+                    raise ValueError("block %d of %s doesn't match the manifest" % (i, self.source_url))
+            with open(image, 'r+b') as f:
+                f.seek(start)
+                f.write(data)
+            with lock:
+                fetched[0] += len(data)
+
+        results, errors = pragma.utils.parallel_map(fetch, self.ranges(changed), self.concurrency)
+        if errors:
+            raise errors.values()[0]
+
+        with open(image, 'r+b') as f:
+            f.truncate(manifest.size)
+        return {'blocks': len(manifest.blocks), 'changed': len(changed), 'bytes': fetched[0],
+            'current': False}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("Usage: python -m pragma.repository.delta <image> [<source>]\n")
+        sys.exit(1)
+    print BlockManifest.create(*sys.argv[1:])
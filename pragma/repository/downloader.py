@@ -0,0 +1,731 @@
+import hashlib
+import httplib
+import json
+import logging
+import os
+import Queue
+import re
+import socket
+import threading
+import time
+import urlparse
+
+import pragma.utils
+from pragma.repository.space import preallocate
+
+logger = logging.getLogger('pragma.repository.downloader')
+
+
+class DownloadError(pragma.utils.PragmaException):
+    """This exception is thrown when a file cannot be downloaded"""
+    pass
+
+
+class ChecksumError(IOError):
+    """This exception is thrown when a downloaded file doesn't match its sha256 checksum"""
+    pass
+
+
+class Downloader(object):
+    """
+    Native download engine for http, https and file urls.
+
+    Data is written to '<path>.partial' and renamed to '<path>' only when
+    the transfer is complete, so an interrupted download is never mistaken
+    for a finished one. An existing partial file is resumed with an http
+    Range request. Large files served with 'Accept-Ranges: bytes' are split
+    into byte range segments that are fetched at the same time. When an
+    expected sha256 digest is given it is computed while the data arrives,
+    and a file that doesn't match is discarded and fetched again. Files of
+    known size are preallocated so their blocks are contiguous.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    MAX_REDIRECTS = 5
+    PARTIAL_SUFFIX = ".partial"
+    SCHEMES = ("http", "https", "file")
+
+    def __init__(self, retries=5, timeout=60, segments=1,
+                 min_segment_size=64 * 1024 * 1024):
+        self.retries = retries
+        self.timeout = timeout
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.pool = ConnectionPool(timeout)
+
+    def close(self):
+        """ close kept-alive connections """
+        self.pool.close()
+
+    @staticmethod
+    def supports(url):
+        """ returns True if url can be fetched by the native downloader """
+        return Downloader.isLocal(url) or urlparse.urlsplit(url).scheme in Downloader.SCHEMES
+
+    @staticmethod
+    def isLocal(url):
+        """ returns True for file urls and absolute paths """
+        scheme = urlparse.urlsplit(url).scheme
+        return scheme == "file" or (scheme == "" and os.path.isabs(url))
+
+    def fetch(self, url, path, digest=None):
+        """
+        Download url to path, resuming and retrying on failure
+
+        :param url: Remote http(s) or file url
+        :param path: Local destination file
+        :param digest: Expected sha256 hex digest of the file or None
+        :return: Number of bytes of the downloaded file
+        """
+        partial = path + self.PARTIAL_SUFFIX
+        attempt = 0
+        while True:
+            try:
+                sha = None
+                if digest is not None:
+                    sha = hashlib.sha256()
+                if self.isLocal(url):
+                    size = self.fetchFile(url, partial, sha)
+                else:
+                    size = self.fetchHttp(url, partial, sha)
+                if sha is not None and sha.hexdigest() != digest.lower():
+                    self.discard(partial)
+                    raise ChecksumError("sha256 checksum mismatch, expected %s, got %s" % (
+                        digest.lower(), sha.hexdigest()))
+                break
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                attempt += 1
+                self.backoff(url, e, attempt)
+
+        os.rename(partial, path)
+        logger.info("Downloaded %s to %s (%d bytes)" % (url, path, size))
+        return size
+
+    def fetchIfChanged(self, url, path, validators={}):
+        """
+        Download a small file unless it is unchanged since validators were
+        returned by a previous call. Http servers are sent If-None-Match and
+        If-Modified-Since headers, so an unchanged file costs a single 304
+        response. File urls are compared by modification time and size.
+
+        :param url: Remote http(s) or file url
+        :param path: Local destination file, only written if changed
+        :param validators: Dictionary returned by a previous call or {}
+        :return: Tuple (changed, validators)
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.isLocal(url):
+                    return self.fetchFileIfChanged(url, path, validators)
+                return self.fetchHttpIfChanged(url, path, validators)
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                attempt += 1
+                self.backoff(url, e, attempt)
+
+    def fetchFileIfChanged(self, url, path, validators):
+        src = urlparse.urlsplit(url).path
+        if not os.path.isfile(src):
+            raise DownloadError("%s: no such file" % url)
+        st = os.stat(src)
+        current = {'mtime': st.st_mtime, 'size': st.st_size}
+        if validators == current:
+            return False, validators
+        partial = path + self.PARTIAL_SUFFIX
+        self.fetchFile(url, partial)
+        os.rename(partial, path)
+        return True, current
+
+    def fetchHttpIfChanged(self, url, path, validators):
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        response = self.request("GET", url, headers)
+        if response.status == 304:
+            response.read()
+            logger.debug("%s is not modified" % url)
+            return False, validators
+        if response.status != 200:
+            response.read()
+            raise DownloadError("%s: HTTP %d %s" % (url, response.status, response.reason))
+
+        partial = path + self.PARTIAL_SUFFIX
+        with open(partial, 'wb') as f:
+            while True:
+                data = response.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+        total = response.getheader('content-length')
+        if total is not None:
+            self.checkSize(url, partial, int(total))
+        os.rename(partial, path)
+        return True, {'etag': response.getheader('etag'),
+                      'last_modified': response.getheader('last-modified')}
+
+    def iterate(self, url):
+        """
+        Generator returning the content of url in chunks without writing
+        it to disk. An interrupted http transfer is resumed with a Range
+        request from the last byte returned.
+        """
+        if self.isLocal(url):
+            with open(urlparse.urlsplit(url).path, 'rb') as f:
+                while True:
+                    data = f.read(self.CHUNK_SIZE)
+                    if not data:
+                        return
+                    yield data
+
+        offset = 0
+        attempt = 0
+        while True:
+            try:
+                headers = {}
+                if offset:
+                    headers['Range'] = 'bytes=%d-' % offset
+                response = self.request("GET", url, headers)
+                expected = 206 if offset else 200
+                if response.status != expected:
+                    response.read()
+                    raise DownloadError("%s: HTTP %d %s" % (url, response.status, response.reason))
+                if offset:
+                    total = self.parseTotal(response.getheader('content-range'))
+                else:
+                    total = response.getheader('content-length')
+                    if total is not None:
+                        total = int(total)
+                while True:
+                    data = response.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    offset += len(data)
+                    yield data
+                if total is not None and offset != total:
+                    raise IOError("transfer ended after %d of %d bytes" % (offset, total))
+                return
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                attempt += 1
+                self.backoff(url, e, attempt)
+
+    def size(self, url):
+        """ returns the size in bytes of url, None if it can't be found """
+        if self.isLocal(url):
+            path = urlparse.urlsplit(url).path
+            return os.path.getsize(path) if os.path.isfile(path) else None
+        try:
+            response = self.request("HEAD", url)
+            response.read()
+        except (socket.error, httplib.HTTPException, DownloadError) as e:
+            logger.debug("HEAD %s failed: %s" % (url, e))
+            return None
+        total = response.getheader('content-length')
+        if response.status != 200 or total is None:
+            return None
+        return int(total)
+
+    def fetchRange(self, url, start, end):
+        """
+        Returns bytes start to end (inclusive) of url, retrying on failure.
+        Raises DownloadError if the server doesn't honor the Range request.
+        """
+        attempt = 0
+        while True:
+            try:
+                if self.isLocal(url):
+                    with open(urlparse.urlsplit(url).path, 'rb') as f:
+                        f.seek(start)
+                        data = f.read(end + 1 - start)
+                else:
+                    response = self.request("GET", url, {'Range': 'bytes=%d-%d' % (start, end)})
+                    if response.status != 206:
+                        response.read()
+                        raise DownloadError("%s: expected HTTP 206 for a byte range, got %d %s" % (
+                            url, response.status, response.reason))
+                    data = response.read()
+                if len(data) != end + 1 - start:
+                    raise IOError("got %d of %d bytes at offset %d" % (len(data), end + 1 - start, start))
+                return data
+            except (socket.error, httplib.HTTPException, IOError) as e:
+                attempt += 1
+                self.backoff(url, e, attempt)
+
+    def backoff(self, url, error, attempt):
+        """ wait before retry number attempt, raise DownloadError when out of retries """
+        if attempt > self.retries:
+            raise DownloadError("%s: %s (gave up after %d retries)" % (url, error, self.retries))
+        wait = min(2 ** attempt, 30)
+        logger.warning("Download of %s interrupted: %s. Resuming in %d secs" % (url, error, wait))
+        time.sleep(wait)
+
+    @staticmethod
+    def discard(partial):
+        """ remove a partial file and its segments state """
+        for path in (partial, partial + SegmentedDownload.STATE_SUFFIX):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    @staticmethod
+    def hashPrefix(path, size, sha):
+        """ add the first size bytes of an existing file to sha """
+        with open(path, 'rb') as f:
+            while size > 0:
+                data = f.read(min(Downloader.CHUNK_SIZE, size))
+                if not data:
+                    break
+                sha.update(data)
+                size -= len(data)
+
+    def fetchFile(self, url, partial, sha=None):
+        """ copy a file url to partial file """
+        src = urlparse.urlsplit(url).path
+        if not os.path.isfile(src):
+            raise DownloadError("%s: no such file" % url)
+        with open(src, 'rb') as fin:
+            with open(partial, 'wb') as fout:
+                preallocate(fout, os.path.getsize(src))
+                while True:
+                    data = fin.read(self.CHUNK_SIZE)
+                    if not data:
+                        break
+                    fout.write(data)
+                    if sha is not None:
+                        sha.update(data)
+        total = os.path.getsize(src)
+        self.checkSize(url, partial, total)
+        return total
+
+    def fetchHttp(self, url, partial, sha=None):
+        """ get url with a Range request appending to partial file """
+        if self.segments > 1 or os.path.isfile(partial + SegmentedDownload.STATE_SUFFIX):
+            size = self.fetchSegmented(url, partial, sha)
+            if size is not None:
+                return size
+
+        offset = 0
+        if os.path.isfile(partial):
+            offset = os.path.getsize(partial)
+
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+        response = self.request("GET", url, headers)
+
+        if response.status == 416:
+            # nothing left to fetch, partial file may already be complete
+            response.read()
+            total = self.parseTotal(response.getheader('content-range'))
+            if total is not None and total == offset:
+                if sha is not None:
+                    self.hashPrefix(partial, offset, sha)
+                return total
+            logger.warning("Discarding unusable partial file %s" % partial)
+            os.remove(partial)
+            raise IOError("range not satisfiable, restarting download")
+
+        if response.status == 206:
+            total = self.parseTotal(response.getheader('content-range'))
+            mode = 'ab'
+            logger.info("Resuming %s at byte %d" % (url, offset))
+            if sha is not None:
+                self.hashPrefix(partial, offset, sha)
+        elif response.status == 200:
+            total = response.getheader('content-length')
+            if total is not None:
+                total = int(total)
+            offset = 0
+            mode = 'wb'
+        else:
+            response.read()
+            raise DownloadError("%s: HTTP %d %s" % (url, response.status, response.reason))
+
+        with open(partial, mode) as f:
+            if total is not None:
+                preallocate(f, total)
+            while True:
+                data = response.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                f.write(data)
+                if sha is not None:
+                    sha.update(data)
+
+        if total is not None:
+            self.checkSize(url, partial, total)
+        return os.path.getsize(partial)
+
+    def fetchSegmented(self, url, partial, sha=None):
+        """
+        Get url as several byte range segments fetched at the same time.
+
+        :return: Size of the downloaded file or None if the server does not
+            support ranges or the file is too small to be split
+        """
+        transfer = SegmentedDownload(self, url, partial, sha)
+        if not transfer.load():
+            if os.path.isfile(partial):
+                # resume an earlier single stream transfer instead
+                return None
+            response = self.request("HEAD", url)
+            response.read()
+            total = response.getheader('content-length')
+            if response.status != 200 or total is None:
+                return None
+            if response.getheader('accept-ranges', '').lower() != 'bytes':
+                logger.debug("%s does not accept ranges, using a single stream" % url)
+                return None
+            total = int(total)
+            count = min(self.segments, total // self.min_segment_size)
+            if count < 2:
+                return None
+            transfer.create(total, count)
+
+        return transfer.run()
+
+    def request(self, method, url, headers={}):
+        """
+        Send request following redirects. Connections are taken from the
+        connection pool and returned to it once the response is read.
+
+        :return: A PooledResponse
+        """
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path = "%s?%s" % (path, parts.query)
+            response = self.pool.request(parts.scheme, parts.netloc, method, path, headers)
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('location')
+                response.read()
+                if not location:
+                    raise DownloadError("%s: redirect without location" % url)
+                url = urlparse.urljoin(url, location)
+                logger.debug("Redirected to %s" % url)
+                continue
+            return response
+        raise DownloadError("%s: too many redirects" % url)
+
+    @staticmethod
+    def parseTotal(content_range):
+        """ returns total size from a 'bytes start-end/total' header """
+        if content_range is None:
+            return None
+        result = re.search(r"/(\d+)\s*$", content_range)
+        if result:
+            return int(result.group(1))
+        return None
+
+    @staticmethod
+    def checkSize(url, partial, total):
+        """ raise IOError if partial file size differs from expected total """
+        size = os.path.getsize(partial)
+        if size < total:
+            raise IOError("transfer ended after %d of %d bytes" % (size, total))
+        if size > total:
+            os.remove(partial)
+            raise IOError("got %d bytes but %d were expected" % (size, total))
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive http(s) connections shared by all transfers of a run, so
+    each file fetch doesn't pay for a new TCP connection and TLS handshake.
+    A connection is used by one request at a time and goes back to the
+    pool of its host when its response has been read completely.
+    """
+    MAX_IDLE = 16  # idle connections kept per host
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.idle = {}  # format {(scheme, netloc): [connection, ...]}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, netloc):
+        """ returns (connection, reused) for host, reusing an idle one if any """
+        with self.lock:
+            conns = self.idle.get((scheme, netloc))
+            if conns:
+                return conns.pop(), True
+        return self.connect(scheme, netloc), False
+
+    def connect(self, scheme, netloc):
+        """ returns a new connection to host """
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        """ return an idle connection to the pool """
+        with self.lock:
+            conns = self.idle.setdefault((scheme, netloc), [])
+            if len(conns) < self.MAX_IDLE:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def request(self, scheme, netloc, method, path, headers={}):
+        """ send request on a pooled connection, returns a PooledResponse """
+        conn, reused = self.get(scheme, netloc)
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        except (socket.error, httplib.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # the server closed the idle connection, try a new one
+            logger.debug("Kept-alive connection to %s was closed, reconnecting" % netloc)
+            conn = self.connect(scheme, netloc)
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        return PooledResponse(self, scheme, netloc, conn, response)
+
+    def close(self):
+        """ close all idle connections """
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+class PooledResponse(object):
+    """
+    Wraps a httplib response and gives its connection back to the pool
+    once the response body has been read.
+    """
+    def __init__(self, pool, scheme, netloc, conn, response):
+        self.pool = pool
+        self.scheme = scheme
+        self.netloc = netloc
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.released = False
+        self.release()
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        try:
+            data = self.response.read(amt)
+        except:
+            self.conn.close()
+            self.released = True
+            raise
+        self.release()
+        return data
+
+    def release(self):
+        """ return connection to the pool if the response is complete """
+        if self.released or not self.response.isclosed():
+            return
+        self.released = True
+        if self.response.will_close:
+            self.conn.close()
+        else:
+            self.pool.put(self.scheme, self.netloc, self.conn)
+
+
+def readahead(chunks, depth=16):
+    """
+    Generator returning the items of iterable chunks while a background
+    thread keeps up to depth items ready, so slow consumers such as a
+    decompressor don't stall the network transfer. When the consumer
+    stops early, e.g. on an error, the thread stops too and closes chunks
+    so its connections and files are released.
+    """
+    queue = Queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        """ returns False if the consumer stopped before item was queued """
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            for data in chunks:
+                if not put((data, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    t = threading.Thread(target=producer)
+    t.daemon = True
+    t.start()
+    try:
+        while True:
+            data, error = queue.get()
+            if data is done:
+                if error is not None:
+                    raise error
+                return
+            yield data
+    finally:
+        stop.set()
+
+
+class SegmentedDownload(object):
+    """
+    A single file downloaded as several byte range segments. Segments are
+    written into a preallocated partial file, each worker seeking its own
+    file object to the segment offset. Progress is kept in
+    '<path>.partial.segments' so an interrupted transfer resumes every
+    segment where it stopped.
+
+    The digest follows the contiguous prefix of the file written so far:
+    chunks continuing it are hashed from memory, chunks written ahead by
+    other segments are read back from the page cache once the prefix
+    reaches them.
+    """
+    STATE_SUFFIX = ".segments"
+
+    def __init__(self, downloader, url, partial, sha=None):
+        self.downloader = downloader
+        self.url = url
+        self.partial = partial
+        self.state_file = partial + self.STATE_SUFFIX
+        self.segments = []  # format [[start, end, bytes done], ...]
+        self.lock = threading.Lock()
+        self.sha = sha
+        self.hashed = 0         # bytes from the file start added to sha
+        self.hashing = False    # a thread is updating sha
+        self.hash_lock = threading.Lock()
+
+    def create(self, total, count):
+        """ split total bytes in count segments and preallocate the file """
+        size = total // count
+        self.segments = []
+        for i in range(count):
+            start = i * size
+            end = total - 1 if i == count - 1 else start + size - 1
+            self.segments.append([start, end, 0])
+        with open(self.partial, 'wb') as f:
+            f.truncate(total)
+            preallocate(f, total)
+        self.save()
+
+    def load(self):
+        """ read saved segment progress, returns True if found """
+        if not os.path.isfile(self.state_file):
+            return False
+        if not os.path.isfile(self.partial):
+            os.remove(self.state_file)
+            return False
+        try:
+            with open(self.state_file, 'r') as f:
+                self.segments = json.load(f)
+        except ValueError:
+            logger.warning("Discarding corrupted %s" % self.state_file)
+            os.remove(self.state_file)
+            os.remove(self.partial)
+            return False
+        return True
+
+    def save(self):
+        with self.lock:
+            tmp = self.state_file + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.segments, f)
+            os.rename(tmp, self.state_file)
+
+    def total(self):
+        return self.segments[-1][1] + 1
+
+    def written(self):
+        """ returns number of bytes written without gaps from the file start """
+        for start, end, done in self.segments:
+            if start + done <= end:
+                return start + done
+        return self.total()
+
+    def hashChunk(self, offset, data):
+        """
+        Add data written at offset to the digest if it continues the hashed
+        prefix, then catch up with bytes written by other segments. Only one
+        thread hashes at a time, the others leave their chunks to be read
+        back by it.
+        """
+        if self.sha is None:
+            return
+        with self.hash_lock:
+            if self.hashing:
+                return
+            self.hashing = True
+        try:
+            if data is not None and offset == self.hashed:
+                self.sha.update(data)
+                self.hashed += len(data)
+            frontier = self.written()
+            if self.hashed < frontier:
+                with open(self.partial, 'rb') as f:
+                    f.seek(self.hashed)
+                    while self.hashed < frontier:
+                        data = f.read(min(Downloader.CHUNK_SIZE, frontier - self.hashed))
+                        if not data:
+                            break
+                        self.sha.update(data)
+                        self.hashed += len(data)
+        finally:
+            with self.hash_lock:
+                self.hashing = False
+
+    def run(self):
+        """ fetch all unfinished segments, returns the file size """
+        pending = [i for i, (start, end, done) in enumerate(self.segments)
+            if start + done <= end]
+        logger.info("Downloading %s in %d segments (%d remaining)" % (
+            self.url, len(self.segments), len(pending)))
+        results, errors = pragma.utils.parallel_map(
+            self.fetchSegment, pending, len(pending))
+        self.save()
+        if errors:
+            raise IOError("%d of %d segments incomplete" % (len(errors), len(self.segments)))
+
+        os.remove(self.state_file)
+        Downloader.checkSize(self.url, self.partial, self.total())
+        self.hashChunk(self.total(), None)
+        return self.total()
+
+    def fetchSegment(self, index):
+        start, end, done = self.segments[index]
+        response = self.downloader.request("GET", self.url,
+            {'Range': 'bytes=%d-%d' % (start + done, end)})
+        if response.status != 206:
+            response.read()
+            raise IOError("segment %d: expected HTTP 206, got %d" % (index, response.status))
+
+        saved = done
+        # unbuffered, so chunks can be read back for hashing once recorded done
+        with open(self.partial, 'r+b', 0) as f:
+            f.seek(start + done)
+            while start + done <= end:
+                data = response.read(min(Downloader.CHUNK_SIZE, end + 1 - start - done))
+                if not data:
+                    break
+                f.write(data)
+                offset = start + done
+                done += len(data)
+                self.segments[index][2] = done
+                self.hashChunk(offset, data)
+                if done - saved >= 64 * Downloader.CHUNK_SIZE:
+                    f.flush()
+                    self.save()
+                    saved = done
+        if start + done <= end:
+            raise IOError("segment %d ended after %d of %d bytes" % (index, done, end - start + 1))
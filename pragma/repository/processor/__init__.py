@@ -1,26 +1,70 @@
+import importlib
+
+from pragma.utils import Abort
+
 # Import processors
 from gzip import Gzip
 from splited_gzip import SplitedGzip
 from splited import Splited
 from raw import Raw
+from zstd import Zstd
+from splited_zstd import SplitedZstd
+from xz import Xz
+from lz4 import Lz4
 
 
 DEFAULT_PROCESSOR = "raw"
+# Registry of processors for the <file type="..."> of cluster xml files,
+# used by the FileProcessor pipeline
 PROCESSORS = {
     "gzip": Gzip,
     "splited_gzip": SplitedGzip,
     "splited": Splited,
     "raw": Raw,
+    "zstd": Zstd,
+    "splited_zstd": SplitedZstd,
+    "xz": Xz,
+    "lz4": Lz4,
 }
 
 
-def process_file(base_dir, f):
+def register(type, processor):
     """
-    Instiate appropriate processor and call process()
+    Add a processor class (a BaseProcessor subclass) for a file type
+    """
+    PROCESSORS[type] = processor
+
+
+def get_processor(type):
+    """
+    Returns the processor class registered for a file type
     """
     try:
-        processor = f.attrib["type"]
+        return PROCESSORS[type]
     except KeyError:
-        processor = DEFAULT_PROCESSOR
-    processor = PROCESSORS[processor](base_dir, f)
-    processor.process()
+        Abort("Unknown image file type '%s'. Known types are %s" % (
+            type, ", ".join(sorted(PROCESSORS.keys()))))
+
+
+def load_processors(modules):
+    """
+    Import site processor modules. A module adds its processors by
+    defining a PROCESSORS dictionary of file types and processor classes
+    or by calling register()
+    """
+    for name in modules:
+        try:
+            module = importlib.import_module(name)
+        except ImportError as e:
+            Abort("Unable to load processor module %s: %s" % (name, e))
+        for type, processor in getattr(module, 'PROCESSORS', {}).items():
+            register(type, processor)
+
+
+def process_file(base_dir, f, record=None):
+    """
+    Process the image of a <file> element with the FileProcessor pipeline
+    """
+    # imported here, fileprocessor imports this module
+    from fileprocessor import FileProcessor
+    FileProcessor.fromElement(base_dir, f, record=record).process()
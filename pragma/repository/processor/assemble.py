@@ -0,0 +1,185 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import time
+
+from pragma.repository.space import preallocate
+
+logger = logging.getLogger('pragma_boot')
+
+# lseek whence values for sparse files (Linux)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# errors meaning a copy method is not available for these files
+UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _libcFunction(name, argtypes):
+    """ returns a libc function or None if this libc doesn't have it """
+    try:
+        func = getattr(_libc, name)
+    except (AttributeError, TypeError):
+        return None
+    func.argtypes = argtypes
+    func.restype = ctypes.c_ssize_t
+    return func
+
+_copy_file_range = _libcFunction("copy_file_range", [ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+    ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _libcFunction("sendfile64", [ctypes.c_int, ctypes.c_int,
+    ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t])
+
+
+class Assembler(object):
+    """
+    Join the parts of a splited image into one file inside the kernel.
+
+    Data is copied with copy_file_range(2), which lets the filesystem
+    share or clone blocks, or with sendfile(2), and only falls back to
+    read and write in user space when neither works for the files. Holes
+    of sparse parts are skipped so the image stays sparse. Parts are
+    deleted only once the image is complete, so an assembly that fails,
+    e.g. when the disk is full, can be run again without downloading them.
+    """
+    CHUNK_SIZE = 64 * 1024 * 1024
+
+    def __init__(self):
+        self.method = None  # copy method used last
+
+    def assemble(self, parts, output, delete=True):
+        """
+        Concatenate parts into output
+
+        :param parts: List of part paths in order
+        :param output: Path of the assembled file
+        :param delete: Remove the parts once output is complete
+        :return: Dictionary with 'bytes' and 'seconds'
+        """
+        start_time = time.time()
+        total = 0
+        for part in parts:
+            total += os.path.getsize(part)
+
+        partial = output + ".partial"
+        fd_out = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            # holes are left wherever no data is copied
+            os.ftruncate(fd_out, total)
+            offset = 0
+            for part in parts:
+                fd_in = os.open(part, os.O_RDONLY)
+                try:
+                    size = os.fstat(fd_in).st_size
+                    for start, end in self.dataExtents(fd_in, size):
+                        # allocate the data contiguously, holes stay holes
+                        preallocate(fd_out, end - start, offset + start)
+                        self.copy(fd_in, start, fd_out, offset + start, end - start)
+                finally:
+                    os.close(fd_in)
+                offset += size
+        except:
+            os.close(fd_out)
+            os.remove(partial)
+            raise
+        os.close(fd_out)
+        os.rename(partial, output)
+        if delete:
+            for part in parts:
+                logger.debug("Deleting part %s" % part)
+                os.remove(part)
+
+        seconds = time.time() - start_time
+        mb = 1024.0 * 1024.0
+        rate = total / mb / seconds if seconds > 0 else 0
+        logger.info("Assembled %s from %d parts: %.1f MB in %.1f secs (%.1f MB/s, %s)" % (
+            output, len(parts), total / mb, seconds, rate, self.method))
+        return {'bytes': total, 'seconds': seconds}
+
+    @staticmethod
+    def dataExtents(fd, size):
+        """
+        Returns list of (start, end) byte ranges of fd holding data. The
+        whole file is one range if the filesystem can't report holes.
+        """
+        extents = []
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # only a hole is left
+                return [(pos, size)]
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            extents.append((start, end))
+            pos = end
+        return extents
+
+    def copy(self, fd_in, off_in, fd_out, off_out, length):
+        """ copy length bytes from off_in of fd_in to off_out of fd_out """
+        while length > 0:
+            done = 0
+            if self.method in (None, "copy_file_range") and _copy_file_range:
+                done = self.copyFileRange(fd_in, off_in, fd_out, off_out, length)
+                if done is not None:
+                    self.method = "copy_file_range"
+            if not done and self.method in (None, "copy_file_range", "sendfile") and _sendfile:
+                done = self.sendfile(fd_in, off_in, fd_out, off_out, length)
+                if done is not None:
+                    self.method = "sendfile"
+            if not done:
+                done = self.readWrite(fd_in, off_in, fd_out, off_out, length)
+                self.method = "read/write"
+            off_in += done
+            off_out += done
+            length -= done
+
+    def copyFileRange(self, fd_in, off_in, fd_out, off_out, length):
+        """ returns bytes copied or None if copy_file_range can't be used """
+        src = ctypes.c_int64(off_in)
+        dst = ctypes.c_int64(off_out)
+        done = _copy_file_range(fd_in, ctypes.byref(src), fd_out, ctypes.byref(dst),
+            min(length, self.CHUNK_SIZE), 0)
+        if done < 0:
+            err = ctypes.get_errno()
+            if err in UNSUPPORTED:
+                return None
+            raise OSError(err, os.strerror(err))
+        if done == 0:
+            raise IOError("unexpected end of file at byte %d" % off_in)
+        return done
+
+    def sendfile(self, fd_in, off_in, fd_out, off_out, length):
+        """ returns bytes copied or None if sendfile can't be used """
+        src = ctypes.c_int64(off_in)
+        os.lseek(fd_out, off_out, os.SEEK_SET)
+        done = _sendfile(fd_out, fd_in, ctypes.byref(src), min(length, self.CHUNK_SIZE))
+        if done < 0:
+            err = ctypes.get_errno()
+            if err in UNSUPPORTED:
+                return None
+            raise OSError(err, os.strerror(err))
+        if done == 0:
+            raise IOError("unexpected end of file at byte %d" % off_in)
+        return done
+
+    def readWrite(self, fd_in, off_in, fd_out, off_out, length):
+        """ copy through user space, returns bytes copied """
+        os.lseek(fd_in, off_in, os.SEEK_SET)
+        data = os.read(fd_in, min(length, 1024 * 1024))
+        if not data:
+            raise IOError("unexpected end of file at byte %d" % off_in)
+        os.lseek(fd_out, off_out, os.SEEK_SET)
+        written = 0
+        while written < len(data):
+            written += os.write(fd_out, data[written:])
+        return len(data)
@@ -1,16 +1,48 @@
 import os
+import xml.etree.ElementTree as ET
+from pragma.repository.processor.threads import THREAD_CAP
 
 
 class BaseProcessor(object):
-    """BaseProcessor"""
-    def __init__(self, base_dir, f):
+    """
+    BaseProcessor
+
+    Subclasses implement process(), and stream() if they can build the
+    image from the content of its parts as it is downloaded. STAGE names
+    the stage of the image pipeline the processor runs, None when it
+    does nothing.
+    """
+    STAGE = "decompress"
+    STREAMABLE = False
+
+    def __init__(self, base_dir, f, threads=None):
         super(BaseProcessor, self).__init__()
         self.base_dir = base_dir
         self.f = f  # File
+        # threads of external decompressors, defaults to the global cap
+        self.threads = threads or THREAD_CAP.threads
 
         self.parts = []
         for part in self.f.findall("./part"):
             self.parts.append(os.path.join(self.base_dir, part.text))
 
+    @classmethod
+    def create(cls, base_dir, filename, parts, threads=None):
+        """ Instantiate processor for an image file and its parts
+            instead of a <file> element of a cluster xml """
+        f = ET.Element("file", {"filename": filename})
+        for part in parts:
+            ET.SubElement(f, "part").text = part
+        return cls(base_dir, f, threads)
+
     def process(self):
         raise NotImplementedError
+
+    def stream(self, chunks, out):
+        """ write the image built from chunks of the parts content to
+            the open file out """
+        raise NotImplementedError
+
+    def outputs(self):
+        """ returns the paths of the files written by process() """
+        return [os.path.join(self.base_dir, self.f.attrib["filename"])]
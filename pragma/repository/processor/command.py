@@ -0,0 +1,62 @@
+from pragma.repository.processor.baseprocessor import BaseProcessor
+from pragma.repository.processor.sparse import decompress, readFiles
+from pragma.utils import Abort, which
+import os
+import logging
+
+
+logger = logging.getLogger('pragma_boot')
+
+
+class CommandProcessor(BaseProcessor):
+    """
+    Command Processor
+
+    Decompress parts with an external program that reads stdin and writes
+    stdout. The output is written sparsely. Subclasses set COMMANDS, the
+    command lines to try in order, and SPLITED if the parts are pieces of
+    a single compressed file rather than compressed files of their own
+    (and STREAMABLE when they can be decompressed while downloaded).
+    """
+    COMMANDS = []
+    SPLITED = False
+
+    def __init__(self, base_dir, f, threads=None):
+        super(CommandProcessor, self).__init__(base_dir, f, threads)
+        if self.SPLITED:
+            self.filename = self.f.attrib["filename"]
+        self.command = self.findCommand()
+
+    def findCommand(self):
+        """ returns the first command line whose program is installed """
+        for command in self.COMMANDS:
+            program = which(command[0])
+            if program is not None:
+                return [program] + [arg % {'threads': self.threads} for arg in command[1:]]
+        Abort("%s requires one of: %s" % (self.__class__.__name__,
+            ", ".join([command[0] for command in self.COMMANDS])))
+
+    def outputs(self):
+        if self.SPLITED:
+            return [os.path.join(self.base_dir, self.filename)]
+        return [os.path.splitext(part)[0] for part in self.parts]
+
+    def stream(self, chunks, out):
+        decompress(self.command, chunks, out)
+
+    def process(self):
+        if self.SPLITED:
+            filename = os.path.join(self.base_dir, self.filename)
+            logger.info("Decompressing %s ..." % filename)
+            with open(filename, 'wb') as out:
+                decompress(self.command, readFiles(self.parts), out)
+            logger.info("Deleting parts...")
+            for part in self.parts:
+                os.remove(part)
+            return
+
+        for part in self.parts:
+            logger.info("Decompressing %s ..." % part)
+            with open(os.path.splitext(part)[0], 'wb') as out:
+                decompress(self.command, readFiles([part]), out)
+            os.remove(part)
@@ -1,86 +1,99 @@
 import os
 import sys
-import subprocess
 import logging
-from pragma.utils import which
+from pragma.repository.processor import DEFAULT_PROCESSOR, PROCESSORS, get_processor
+from pragma.repository.processor.stats import BootRecord
 
 class FileProcessor:
- 
-    def __init__(self, base_dir, fname, parts, type="raw"):
+    """
+    Pipeline building a virtual image from its parts with the processor
+    registered for its type, from parts on disk (process) or while they
+    are downloaded (stream). Bytes in and out and the wall time of the
+    processor stage are added to a BootRecord.
+    """
+
+    def __init__(self, base_dir, fname, parts, type="raw", threads=None, record=None, node=None):
         self.base_dir = base_dir # directory for virtual images in the repository
-        self.filename = fname    # virtyual image filename 
+        self.filename = fname    # virtyual image filename
+        self.threads = threads   # threads of external decompressors
+        self.record = record or BootRecord()
+        self.node = node         # node type of the image, for the record
 
+        self.names = list(parts) # part names relative to base_dir
         self.parts = []          # splitted virtual image splitted parts names
         for part in parts:
             self.parts.append(os.path.join(self.base_dir, part))
 
-        # processing functions to call (values)  depending on the file type (keys)
-        self.programs = {"gzip": "Gzip",
-                         "splited_gzip": "SplitedGzip",
-                         "splited": "Splited",
-                         "raw": "Raw",
-        }
         self.logger = logging.getLogger(self.__module__)
 
         self.setType(type)
-        self.setDecompress()
 
-    def process(self):
-        """Call processing function depending on the  file type"""
-        prog = self.programs[self.type]
-        getattr(self, '%s' % prog)()
-
-    def setType(self,type):
-        if type not in self.programs.keys():
-            print "Error, don't know program to use for decompressing %s" % type
-            sys.exit(-1)
+    @classmethod
+    def fromElement(cls, base_dir, f, **kwargs):
+        """ Instantiate pipeline for a <file> element of a cluster xml """
+        parts = [part.text for part in f.findall("./part")]
+        return cls(base_dir, f.attrib.get("filename"), parts,
+            f.attrib.get("type", DEFAULT_PROCESSOR), **kwargs)
 
-        self.type = type
+    @staticmethod
+    def isStreamable(type):
+        """ returns True if images of type can be built while downloaded """
+        return bool(get_processor(type).STREAMABLE)
 
-    def setDecompress(self):
-        self.decompressor = None 
-        if self.type in ('raw','splitted'):
+    def process(self):
+        """Call the processor registered for the file type"""
+        processor = self.getProcessor()
+        if processor.STAGE is None:
+            processor.process()
             return
 
-        self.decompressor = which("gunzip")
-        if self.decompressor is None:
-            # FIXME add check for not found unpigz
-            self.decompressor = which("unpigz")
-
-
-    def Raw(self):
-        """No processing needed"""
-        return 
-
+        with self.record.stage(processor.STAGE, self.filename, self.node) as stage:
+            # parts are deleted once processed, measure them first
+            stage.bytes_in = sum([os.path.getsize(part) for part in self.parts
+                if os.path.isfile(part)])
+            processor.process()
+            stage.bytes_out = sum([os.path.getsize(output) for output in processor.outputs()
+                if os.path.isfile(output)])
 
-    def Gzip(self):
-        """ Decompress a single file """
+    def getProcessor(self):
+        """ returns processor registered for the file type """
+        return get_processor(self.type).create(self.base_dir, self.filename,
+            self.names, self.threads)
 
-        for part in self.parts:
-            self.logger.info("Decompressing %s ..." % part)
-            self.logger.debug("Execute: %s %s %s" % (self.decompressor, "-f", part))
-            subprocess.check_call([self.decompressor, "-f", part])
-
-    def Splited(self):
-        """Combine splitted files into a single image"""
-
-        command = "cat %s > %s" % (" ".join(self.parts),  self.filename)
-        self.logger.debug("Execute: %s" % command)
-        subprocess.check_call(command, shell=True)  # DANGER!!
-
-        self.logger.info("Deleting parts...")
-        for part in self.parts:
-            os.remove(part)
-
-
-    def SplitedGzip(self):
-        """Combine splitted and decompressed files into a single image"""
+    def setType(self,type):
+        if type not in PROCESSORS:
+            print "Error, don't know program to use for decompressing %s" % type
+            sys.exit(-1)
 
-        command = "cat %s | %s -f > %s" % ( " ".join(self.parts), self.decompressor, self.filename)
-        self.logger.info("Decompressing splited gzip...")
-        self.logger.debug("Execute: %s" % command)
-        subprocess.check_call(command, shell=True)  # DANGER!!
+        self.type = type
 
-        self.logger.info("Deleting parts...")
-        for part in self.parts:
-            os.remove(part)
+    def stream(self, chunks):
+        """
+        Assemble the image from an iterator of data chunks (the parts
+        content in order, e.g. while it is being downloaded) instead of
+        from parts on disk. The image is written sparsely to a temporary
+        file and renamed when complete.
+        """
+        if not self.isStreamable(self.type):
+            raise ValueError("Cannot stream %s images" % self.type)
+
+        processor = self.getProcessor()
+        partial = self.filename + ".partial"
+        self.logger.info("Streaming %s image to %s ..." % (self.type, self.filename))
+        with self.record.stage(processor.STAGE, self.filename, self.node) as stage:
+            stage.streamed = True
+
+            def count(chunks):
+                for data in chunks:
+                    stage.bytes_in += len(data)
+                    yield data
+
+            try:
+                with open(partial, 'wb') as out:
+                    processor.stream(count(chunks), out)
+            except:
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+            os.rename(partial, self.filename)
+            stage.bytes_out = os.path.getsize(self.filename)
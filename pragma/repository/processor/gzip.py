@@ -1,6 +1,8 @@
 from pragma.repository.processor.baseprocessor import BaseProcessor
+from pragma.repository.processor.inflate import ParallelInflate
+from pragma.repository.processor.sparse import decompress, readFiles
 from pragma.utils import which
-import subprocess
+import os
 import logging
 
 
@@ -13,20 +15,40 @@ class Gzip(BaseProcessor):
 
     Decompress a single gzip file
     """
-    def __init__(self, base_dir, f):
+    def __init__(self, base_dir, f, threads=None):
         """
         Gzip Processor
 
-        Decompress gzip file with pigz or gunzip
+        Decompress gzip file with unpigz, or in process on all cores
+        when it is not installed
         """
-        super(Gzip, self).__init__(base_dir, f)
+        super(Gzip, self).__init__(base_dir, f, threads)
 
+        self.inflater = None
         self.decompressor = which("unpigz")
         if self.decompressor is None:
-            self.decompressor = which("gunzip")
+            self.inflater = ParallelInflate()
+
+    def command(self):
+        """ returns unpigz command line """
+        return [self.decompressor, "-c", "-p", str(self.threads)]
+
+    def outputs(self):
+        return [os.path.splitext(part)[0] for part in self.parts]
+
+    def stream(self, chunks, out):
+        if self.inflater:
+            self.inflater.inflateStream(chunks, out)
+        else:
+            decompress(self.command(), chunks, out)
 
     def process(self):
         for part in self.parts:
             logger.info("Decompressing %s ..." % part)
-            logger.debug("Execute: %s %s %s" % (self.decompressor, "-f", part))
-            subprocess.check_call([self.decompressor, "-f", part])
+            output = os.path.splitext(part)[0]
+            if self.inflater:
+                self.inflater.inflate([part], output)
+            else:
+                with open(output, 'wb') as out:
+                    decompress(self.command(), readFiles([part]), out)
+            os.remove(part)
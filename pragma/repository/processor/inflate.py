@@ -0,0 +1,369 @@
+import logging
+import os
+import struct
+import time
+import zlib
+
+import pragma.utils
+from pragma.repository.processor.sparse import SparseWriter
+from pragma.repository.processor.threads import THREAD_CAP
+
+logger = logging.getLogger('pragma_boot')
+
+GZIP_MAGIC = "\x1f\x8b\x08"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+FEXTRA = 0x04
+
+
+class InflateError(pragma.utils.PragmaException):
+    """This exception is thrown when gzip data cannot be decompressed"""
+    pass
+
+
+class PartsReader(object):
+    """
+    Random access reads of the concatenation of several files, e.g. the
+    parts of a splited image. Each caller passes its own dictionary of open
+    files so threads don't share file positions.
+    """
+    def __init__(self, paths):
+        self.paths = paths
+        self.starts = []
+        self.size = 0
+        for path in paths:
+            self.starts.append(self.size)
+            self.size += os.path.getsize(path)
+
+    def read(self, offset, length, handles):
+        """ returns up to length bytes starting at offset """
+        data = []
+        for i, path in enumerate(self.paths):
+            if length <= 0:
+                break
+            start = self.starts[i]
+            end = self.starts[i + 1] if i + 1 < len(self.paths) else self.size
+            if offset >= end or offset + length <= start:
+                continue
+            if path not in handles:
+                handles[path] = open(path, 'rb')
+            f = handles[path]
+            f.seek(offset - start)
+            chunk = f.read(min(length, end - offset))
+            data.append(chunk)
+            offset += len(chunk)
+            length -= len(chunk)
+        return "".join(data)
+
+    @staticmethod
+    def close(handles):
+        for f in handles.values():
+            f.close()
+
+
+class ParallelInflate(object):
+    """
+    Decompress gzip files in process on several threads.
+
+    A gzip file made of several independent members (for example written
+    by bgzip, whose block headers carry the compressed block size, or by
+    concatenating separately compressed chunks) is split at its member
+    boundaries. The output offset of each member comes from the size in
+    its trailer, so members are inflated by a pool of threads writing at
+    their own position in a preallocated output file. zlib releases the
+    interpreter lock while inflating, so the threads run on separate
+    cores. Each thread holds a slot of the global THREAD_CAP while it
+    inflates, so images decompressed at the same time share the cores.
+    Blocks of zeros are not written, so the output is sparse.
+
+    A file with a single member, or whose member boundaries cannot be
+    trusted, is inflated by a single thread. The scan for member headers
+    gives up after MAX_MEMBER_SCAN bytes without one, so a large single
+    member file is not read twice.
+    """
+    READ_SIZE = 1024 * 1024
+    SCAN_SIZE = 16 * 1024 * 1024
+    MAX_MEMBER_SCAN = 128 * 1024 * 1024  # compressed bytes searched for the next member
+    PROBE_SIZE = 64 * 1024
+    BATCH_SIZE = 32 * 1024 * 1024  # compressed bytes per worker task
+
+    def __init__(self, threads=None):
+        self.threads = max(1, threads or THREAD_CAP.threads)
+
+    def inflate(self, inputs, output):
+        """
+        Decompress the concatenation of the input files to output
+
+        :param inputs: List of gzip file paths, e.g. parts of one image
+        :param output: Path of the decompressed file
+        :return: Dictionary with 'in_bytes', 'out_bytes' and 'seconds'
+        """
+        start_time = time.time()
+        reader = PartsReader(inputs)
+        members = self.findMembers(reader)
+        threads = 1
+        if len(members) > 1 and self.threads > 1:
+            try:
+                out_bytes = self.inflateMembers(reader, members, output)
+                threads = self.threads
+            except InflateError as e:
+                logger.warning("Cannot inflate %s in parallel (%s), using a single thread" % (output, e))
+                out_bytes = self.inflateSequential(reader, output)
+        else:
+            out_bytes = self.inflateSequential(reader, output)
+
+        return self.report(output, reader.size, out_bytes, time.time() - start_time, threads)
+
+    def inflateStream(self, chunks, out):
+        """
+        Decompress gzip data from an iterator of chunks to an open file
+        on the calling thread, e.g. while the data is downloaded.
+
+        :return: Dictionary with 'in_bytes', 'out_bytes' and 'seconds'
+        """
+        start_time = time.time()
+        decoder = MemberDecoder(out)
+        in_bytes = 0
+        for data in chunks:
+            in_bytes += len(data)
+            decoder.feed(data)
+        decoder.finish()
+        return self.report(getattr(out, 'name', 'stream'), in_bytes,
+            decoder.out_bytes, time.time() - start_time, 1)
+
+    @staticmethod
+    def report(name, in_bytes, out_bytes, seconds, threads):
+        mb = 1024.0 * 1024.0
+        rate = out_bytes / mb / seconds if seconds > 0 else 0
+        logger.info("Inflated %s: %.1f MB to %.1f MB in %.1f secs (%.1f MB/s, %d threads)" % (
+            name, in_bytes / mb, out_bytes / mb, seconds, rate, threads))
+        return {'in_bytes': in_bytes, 'out_bytes': out_bytes, 'seconds': seconds}
+
+    def findMembers(self, reader):
+        """
+        Returns list of (start, end) compressed byte ranges of the gzip
+        members. Block sizes of bgzip headers are followed without reading
+        the data, otherwise the input is scanned for gzip headers. Returns
+        a single range for the whole input when no header follows a member
+        within MAX_MEMBER_SCAN bytes.
+        """
+        handles = {}
+        try:
+            members = []
+            offset = 0
+            while offset < reader.size:
+                header = reader.read(offset, 18, handles)
+                size = self.bgzfBlockSize(header)
+                if size is None:
+                    break
+                members.append((offset, offset + size))
+                offset += size
+            if offset < reader.size:
+                starts = self.scanHeaders(reader, offset, handles)
+                if starts is None:
+                    return [(0, reader.size)]
+                for i, start in enumerate(starts):
+                    end = starts[i + 1] if i + 1 < len(starts) else reader.size
+                    members.append((start, end))
+            return members
+        finally:
+            PartsReader.close(handles)
+
+    @staticmethod
+    def bgzfBlockSize(header):
+        """ returns the block size of a bgzip member header or None """
+        if len(header) < 18 or not header.startswith(GZIP_MAGIC):
+            return None
+        if not ord(header[3]) & FEXTRA:
+            return None
+        xlen = struct.unpack("<H", header[10:12])[0]
+        if xlen < 6 or header[12:14] != "BC" or struct.unpack("<H", header[14:16])[0] != 2:
+            return None
+        return struct.unpack("<H", header[16:18])[0] + 1
+
+    def scanHeaders(self, reader, offset, handles):
+        """
+        returns offsets of gzip member headers from offset to the end, or
+        None if a member is longer than MAX_MEMBER_SCAN bytes
+        """
+        starts = [offset]
+        pos = offset + 1
+        while pos < reader.size:
+            if pos - starts[-1] > self.MAX_MEMBER_SCAN:
+                logger.debug("No gzip member header within %d bytes of byte %d" % (
+                    self.MAX_MEMBER_SCAN, starts[-1]))
+                return None
+            window = reader.read(pos, self.SCAN_SIZE + len(GZIP_MAGIC) - 1, handles)
+            i = window.find(GZIP_MAGIC)
+            while i >= 0:
+                if self.isMemberStart(reader, pos + i, handles):
+                    starts.append(pos + i)
+                i = window.find(GZIP_MAGIC, i + 1)
+            pos += self.SCAN_SIZE
+        return starts
+
+    def isMemberStart(self, reader, offset, handles):
+        """ check that a gzip magic number found in the data starts a member """
+        data = reader.read(offset, self.PROBE_SIZE, handles)
+        if len(data) < 18:
+            return False
+        flags = ord(data[3])
+        if flags & 0xe0 or ord(data[8]) not in (0, 2, 4):
+            return False
+        try:
+            zlib.decompressobj(GZIP_WBITS).decompress(data, self.READ_SIZE)
+        except zlib.error:
+            return False
+        return True
+
+    def inflateMembers(self, reader, members, output):
+        """
+        Inflate members on a pool of threads. Raises InflateError if a
+        member doesn't end where the next one starts or its size differs
+        from the one found in its trailer, which records it modulo 2^32.
+        """
+        handles = {}
+        try:
+            offsets = []
+            sizes = []
+            out_bytes = 0
+            for start, end in members:
+                trailer = reader.read(end - 4, 4, handles)
+                offsets.append(out_bytes)
+                sizes.append(struct.unpack("<I", trailer)[0])
+                out_bytes += sizes[-1]
+        finally:
+            PartsReader.close(handles)
+
+        batches = []
+        batch = []
+        size = 0
+        for i, (start, end) in enumerate(members):
+            batch.append(i)
+            size += end - start
+            if size >= self.BATCH_SIZE:
+                batches.append(tuple(batch))
+                batch = []
+                size = 0
+        if batch:
+            batches.append(tuple(batch))
+
+        with open(output, 'wb') as f:
+            f.truncate(out_bytes)
+
+        def inflateBatch(batch):
+            handles = {}
+            THREAD_CAP.acquire()
+            try:
+                with open(output, 'r+b') as out:
+                    for i in batch:
+                        start, end = members[i]
+                        out.seek(offsets[i])
+                        decoder = MemberDecoder(out, single=True)
+                        pos = start
+                        while pos < end:
+                            data = reader.read(pos, min(self.READ_SIZE, end - pos), handles)
+                            decoder.feed(data)
+                            pos += len(data)
+                        if not decoder.finishMember():
+                            raise InflateError("member at byte %d is incomplete" % start)
+                        if decoder.out_bytes % 2 ** 32 != sizes[i]:
+                            raise InflateError("member at byte %d has %d bytes instead of %d" % (
+                                start, decoder.out_bytes, sizes[i]))
+                        if decoder.out_bytes != sizes[i]:
+                            # output offsets of the next members are wrong
+                            raise InflateError("member at byte %d has %d bytes, over 4 GB" % (
+                                start, decoder.out_bytes))
+            finally:
+                THREAD_CAP.release()
+                PartsReader.close(handles)
+
+        logger.info("Inflating %d gzip members with %d threads" % (len(members), self.threads))
+        results, errors = pragma.utils.parallel_map(inflateBatch, batches, self.threads)
+        if errors:
+            raise InflateError(errors.values()[0])
+        return out_bytes
+
+    def inflateSequential(self, reader, output):
+        """ inflate all members one after the other, returns output size """
+        handles = {}
+        THREAD_CAP.acquire()
+        try:
+            with open(output, 'wb') as out:
+                decoder = MemberDecoder(out)
+                pos = 0
+                while pos < reader.size:
+                    data = reader.read(pos, self.READ_SIZE, handles)
+                    decoder.feed(data)
+                    pos += len(data)
+                decoder.finish()
+                return decoder.out_bytes
+        finally:
+            THREAD_CAP.release()
+            PartsReader.close(handles)
+
+
+class MemberDecoder(object):
+    """
+    Incremental gzip decoder writing sparsely to a file. Several members
+    are decoded one after the other unless single is set, and output is
+    produced in bounded pieces so highly compressed data doesn't fill the
+    memory.
+    """
+    OUT_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, out, single=False):
+        self.out = SparseWriter(out)
+        self.single = single
+        self.out_bytes = 0
+        self.decoder = zlib.decompressobj(GZIP_WBITS)
+        self.started = False  # current member has input
+        self.padding = False  # zeros after the last member
+
+    def feed(self, data):
+        if self.padding:
+            if data.strip("\0"):
+                raise InflateError("trailing garbage after gzip data")
+            return
+        while data:
+            self.started = True
+            try:
+                chunk = self.decoder.decompress(data, self.OUT_SIZE)
+                self.write(chunk)
+                while self.decoder.unconsumed_tail:
+                    chunk = self.decoder.decompress(self.decoder.unconsumed_tail, self.OUT_SIZE)
+                    self.write(chunk)
+            except zlib.error as e:
+                raise InflateError("invalid gzip data: %s" % e)
+            data = self.decoder.unused_data
+            if not data:
+                return
+            # end of member, the rest of the data starts the next one
+            if self.single:
+                raise InflateError("member ends %d bytes early" % len(data))
+            if data.strip("\0") == "":
+                # trailing zero padding is ignored, as gzip does
+                self.padding = True
+                self.started = False
+                return
+            self.decoder = zlib.decompressobj(GZIP_WBITS)
+            self.started = False
+
+    def write(self, chunk):
+        if chunk:
+            self.out.write(chunk)
+            self.out_bytes += len(chunk)
+
+    def finishMember(self):
+        """ returns True if the current member ended with the data fed """
+        try:
+            self.decoder.decompress("\0")
+        except zlib.error:
+            return False
+        return self.decoder.unused_data == "\0"
+
+    def finish(self):
+        """ raise InflateError if the data ended inside a member, set the
+            size of the output file """
+        if self.started and not self.finishMember():
+            raise InflateError("unexpected end of gzip data")
+        self.out.finish()
@@ -0,0 +1,12 @@
+from pragma.repository.processor.command import CommandProcessor
+
+
+class Lz4(CommandProcessor):
+    """
+    Lz4 Processor
+
+    Decompress lz4 files
+    """
+    COMMANDS = [
+        ["lz4", "-d", "-c", "-q"],
+    ]
@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('pragma_boot')
+
+
+class ImageManifest(object):
+    """
+    Record of an image assembled from its parts, kept next to the image
+    in '<image>.processed'. It lists the processor type, the source parts
+    with their sizes and sha256 checksums, and the size and modification
+    time of the output. It is written only when processing completed, so
+    an image whose manifest matches its cluster xml description and whose
+    output is unchanged needs no processing.
+    """
+    SUFFIX = ".processed"
+
+    def __init__(self, image):
+        self.image = image
+        self.path = image + self.SUFFIX
+
+    def read(self):
+        """ returns the recorded manifest or None """
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            logger.warning("Ignoring corrupted %s" % self.path)
+            return None
+
+    def write(self, type, parts, sizes={}, digests={}):
+        """
+        Record that image was processed from parts
+
+        :param type: Processor type
+        :param parts: Part names in order
+        :param sizes: Dictionary of part names and sizes in bytes
+        :param digests: Dictionary of part names and sha256 checksums
+        """
+        st = os.stat(self.image)
+        manifest = {
+            'type': type,
+            'parts': [{'name': part, 'size': sizes.get(part),
+                       'sha256': digests.get(part)} for part in parts],
+            'output': os.path.basename(self.image),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'completed': time.time(),
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def isValid(self, type, parts, digests={}):
+        """
+        Returns True if the image was processed with type from the same
+        parts and checksums and the output was not changed since
+        """
+        manifest = self.read()
+        if manifest is None or 'completed' not in manifest:
+            return False
+        if manifest['type'] != type:
+            return False
+        if [part['name'] for part in manifest['parts']] != list(parts):
+            return False
+        for part in manifest['parts']:
+            if digests.get(part['name']) != part['sha256']:
+                return False
+        try:
+            st = os.stat(self.image)
+        except OSError:
+            return False
+        return st.st_size == manifest['size'] and st.st_mtime == manifest['mtime']
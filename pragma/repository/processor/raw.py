@@ -7,8 +7,13 @@ class Raw(BaseProcessor):
 
     Do nothing
     """
-    def __init__(self, base_dir, f):
-        super(Raw, self).__init__(base_dir, f)
+    def __init__(self, base_dir, f, threads=None):
+        super(Raw, self).__init__(base_dir, f, threads)
+
+    STAGE = None
 
     def process(self):
         pass
+
+    def outputs(self):
+        return []
@@ -0,0 +1,110 @@
+import logging
+import subprocess
+import threading
+
+logger = logging.getLogger('pragma_boot')
+
+READ_SIZE = 1024 * 1024
+
+
+class SparseWriter(object):
+    """
+    Write data to a file, seeking over all-zero blocks instead of writing
+    them so they stay holes. Blocks are aligned to the file offset so the
+    holes match filesystem blocks. Call finish() to set the file size when
+    the data ends with zeros.
+    """
+    BLOCK_SIZE = 64 * 1024
+    ZERO_BLOCK = "\0" * BLOCK_SIZE
+
+    def __init__(self, f):
+        self.f = f
+        self.pos = f.tell()
+        self.bytes = 0   # bytes given to write
+        self.skipped = 0 # zero bytes not written
+
+    def write(self, data):
+        n = len(data)
+        i = 0
+        start = None  # start of the data not written yet
+        while i < n:
+            size = min(self.BLOCK_SIZE - (self.pos + i) % self.BLOCK_SIZE, n - i)
+            if data[i:i + size] == self.ZERO_BLOCK[:size]:
+                if start is not None:
+                    self.f.write(data[start:i])
+                    start = None
+                self.f.seek(self.pos + i + size)
+                self.skipped += size
+            elif start is None:
+                start = i
+            i += size
+        if start is not None:
+            self.f.write(data[start:])
+        self.pos += n
+        self.bytes += n
+
+    def finish(self):
+        """ extend the file to the written size if it ends with a hole """
+        self.f.seek(0, 2)
+        if self.f.tell() < self.pos:
+            self.f.truncate(self.pos)
+        self.f.seek(self.pos)
+
+
+def readFiles(paths):
+    """ Generator returning the content of files in order, in chunks """
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                yield data
+
+
+def decompress(command, chunks, out):
+    """
+    Run a decompressor that reads stdin and writes stdout, e.g.
+    ['unpigz', '-c'], feeding it chunks from a thread and writing its
+    output sparsely to the open file out.
+
+    :return: Number of decompressed bytes
+    """
+    logger.debug("Execute: %s" % " ".join(command))
+    p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    errors = []
+
+    def feed():
+        try:
+            for data in chunks:
+                p.stdin.write(data)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+
+    t = threading.Thread(target=feed)
+    t.daemon = True
+    t.start()
+    writer = SparseWriter(out)
+    while True:
+        data = p.stdout.read(READ_SIZE)
+        if not data:
+            break
+        writer.write(data)
+    writer.finish()
+    t.join()
+    rc = p.wait()
+    # a failed input, e.g. a download, is reported rather than the
+    # decompressor error it causes, a broken pipe after it
+    if errors and not isinstance(errors[0], IOError):
+        raise errors[0]
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, command[0])
+    if errors:
+        raise errors[0]
+    logger.info("Decompressed %d bytes, %d bytes of zeros left as holes" % (writer.bytes, writer.skipped))
+    return writer.bytes
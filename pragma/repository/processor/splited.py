@@ -1,6 +1,7 @@
+from pragma.repository.processor.assemble import Assembler
 from pragma.repository.processor.baseprocessor import BaseProcessor
+from pragma.repository.processor.sparse import SparseWriter
 import os
-import subprocess
 import logging
 
 
@@ -9,19 +10,21 @@ logger = logging.getLogger('pragma_boot')
 
 class Splited(BaseProcessor):
     """Splited File Processor"""
-    def __init__(self, base_dir, f):
-        super(Splited, self).__init__(base_dir, f)
+    STAGE = "assemble"
+    STREAMABLE = True
+
+    def __init__(self, base_dir, f, threads=None):
+        super(Splited, self).__init__(base_dir, f, threads)
         self.filename = self.f.attrib["filename"]
 
     def process(self):
-        command = "cat %s > %s" % (
-            " ".join(self.parts),
-            os.path.join(self.base_dir, self.filename)
-        )
-        logger.info("Decompressing splited gzip...")
-        logger.debug("Execute: %s" % command)
-        subprocess.check_call(command, shell=True)  # DANGER!!
+        # parts are deleted once the image is complete
+        filename = os.path.join(self.base_dir, self.filename)
+        logger.info("Assembling %s ..." % filename)
+        Assembler().assemble(self.parts, filename)
 
-        logger.info("Deleting parts...")
-        for part in self.parts:
-            os.remove(part)
+    def stream(self, chunks, out):
+        writer = SparseWriter(out)
+        for data in chunks:
+            writer.write(data)
+        writer.finish()
@@ -1,6 +1,6 @@
 from pragma.repository.processor.gzip import Gzip
+from pragma.repository.processor.sparse import decompress, readFiles
 import os
-import subprocess
 import logging
 
 
@@ -9,19 +9,24 @@ logger = logging.getLogger('pragma_boot')
 
 class SplitedGzip(Gzip):
     """docstring for SplitedGzip"""
-    def __init__(self, base_dir, f):
-        super(SplitedGzip, self).__init__(base_dir, f)
+    STREAMABLE = True
+
+    def __init__(self, base_dir, f, threads=None):
+        super(SplitedGzip, self).__init__(base_dir, f, threads)
         self.filename = self.f.attrib["filename"]
 
+    def outputs(self):
+        return [os.path.join(self.base_dir, self.filename)]
+
     def process(self):
-        command = "cat %s | %s -f > %s" % (
-            " ".join(self.parts),
-            self.decompressor,
-            os.path.join(self.base_dir, self.filename)
-        )
+        filename = os.path.join(self.base_dir, self.filename)
         logger.info("Decompressing splited gzip...")
-        logger.debug("Execute: %s" % command)
-        subprocess.check_call(command, shell=True)  # DANGER!!
+        if self.inflater:
+            self.inflater.inflate(self.parts, filename)
+        else:
+            # zero blocks are left as holes
+            with open(filename, 'wb') as out:
+                decompress(self.command(), readFiles(self.parts), out)
 
         logger.info("Deleting parts...")
         for part in self.parts:
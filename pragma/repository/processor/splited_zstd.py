@@ -0,0 +1,11 @@
+from pragma.repository.processor.zstd import Zstd
+
+
+class SplitedZstd(Zstd):
+    """
+    Splited Zstd Processor
+
+    Combine parts of a zstd file and decompress them into a single image
+    """
+    SPLITED = True
+    STREAMABLE = True
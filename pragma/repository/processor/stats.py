@@ -0,0 +1,105 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('pragma_boot')
+
+MB = 1024.0 * 1024.0
+
+
+class Stage(object):
+    """
+    Measurement of one stage (fetch, assemble, decompress, verify) of
+    getting an image ready. The code running the stage sets bytes_in and
+    bytes_out, the wall time is measured by BootRecord.stage()
+    """
+    def __init__(self, stage, image, node=None):
+        self.stage = stage
+        self.image = image
+        self.node = node
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.streamed = False
+        self.error = None
+
+    def mbps(self):
+        """ returns throughput in MB/s of the larger of input and output """
+        if self.seconds <= 0:
+            return None
+        return round(max(self.bytes_in, self.bytes_out) / MB / self.seconds, 1)
+
+    def asDict(self):
+        d = {
+            'stage': self.stage,
+            'image': self.image,
+            'node': self.node,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'seconds': round(self.seconds, 3),
+            'mbps': self.mbps(),
+        }
+        if self.streamed:
+            d['streamed'] = True
+        if self.error is not None:
+            d['error'] = self.error
+        return d
+
+    def __str__(self):
+        mbps = self.mbps()
+        return "%s %s: %.1f MB to %.1f MB in %.1f secs (%s MB/s)%s" % (
+            self.stage, self.image, self.bytes_in / MB, self.bytes_out / MB,
+            self.seconds, "-" if mbps is None else mbps,
+            " streamed" if self.streamed else "")
+
+
+class BootRecord(object):
+    """
+    Throughput of the stages run to get the images of a virtual cluster
+    ready for a boot. Stages may run in several threads at once. The record
+    is appended as a single json line to repository_dir/.boots
+    """
+    FILENAME = ".boots"
+
+    def __init__(self, vcname=None):
+        self.vcname = vcname
+        self.started = time.time()
+        self.stages = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, stage, image, node=None):
+        """
+        Measure the wall time of the enclosed block as a stage of image.
+        Yields the Stage, whose bytes_in and bytes_out the block sets.
+        A failed stage is recorded with its error.
+        """
+        s = Stage(stage, image, node)
+        start = time.time()
+        try:
+            yield s
+        except Exception as e:
+            s.error = str(e)
+            raise
+        finally:
+            s.seconds = time.time() - start
+            with self.lock:
+                self.stages.append(s)
+            logger.info("Stage %s" % s)
+
+    def asDict(self):
+        with self.lock:
+            stages = [s.asDict() for s in self.stages]
+        return {
+            'vc': self.vcname,
+            'started': self.started,
+            'seconds': round(time.time() - self.started, 3),
+            'stages': stages,
+        }
+
+    def write(self, path):
+        """ append the record as a json line to path """
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.asDict()) + "\n")
@@ -0,0 +1,38 @@
+import multiprocessing
+import threading
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+class ThreadCap(object):
+    """
+    Cap on the decompression threads of all the processors running at the
+    same time. In-process decoders hold a slot while they work, so a
+    single image uses all slots and concurrent images share them.
+    External decompressors can't change their thread count while running
+    and are given an equal share of the cap instead.
+    """
+    def __init__(self, threads=None):
+        self.setThreads(threads)
+
+    def setThreads(self, threads=None):
+        self.threads = max(1, threads or cpu_count())
+        self.slots = threading.BoundedSemaphore(self.threads)
+
+    def share(self, jobs):
+        """ returns threads for each of jobs external decompressors """
+        return max(1, self.threads // max(1, jobs))
+
+    def acquire(self):
+        self.slots.acquire()
+
+    def release(self):
+        self.slots.release()
+
+# cap shared by all processors, set from the decompress_threads setting
+THREAD_CAP = ThreadCap()
@@ -64,6 +64,8 @@ class XmlInput:
                     if not parts:
                         Abort("Error in cluster xml file. Check <part> definition for disk image %s" % diskinfo['file'])
                 diskinfo.update({'parts':parts})
+                diskinfo.update(self.getDigests(node))              # add keys 'sha256', 'digests'
+                diskinfo['size'] = self.getImageSize(node)
                 self.diskinfo[nodetype] = diskinfo
 
             except AttributeError:
@@ -74,7 +76,7 @@ class XmlInput:
         # check if <file type="ftype"> is present
         ftype = node.find(".//file")
         try: 
-            type = ftype.attrib['type']
+            type = ftype.attrib.get('type')
         except AttributeError:
             type = None
 
@@ -87,6 +89,58 @@ class XmlInput:
 
         return type, parts
 
+    def getDigests(self, node):
+        """ collect optional sha256 checksums of the image file and its parts.
+            Returns a dictionary {'sha256': digest of the image file or None,
+            'digests': {'part name': digest, ...}}
+        """
+        digests = {}
+        for item in node.findall(".//part"):
+            if 'sha256' in item.attrib:
+                digests[item.text] = item.attrib['sha256'].lower()
+
+        sha256 = None
+        ftype = node.find(".//file")
+        if ftype is not None and 'sha256' in ftype.attrib:
+            sha256 = ftype.attrib['sha256'].lower()
+
+        return {'sha256': sha256, 'digests': digests}
+
+    def getImageSize(self, node):
+        """ returns the size in bytes of the assembled image declared in
+            the size attribute of <file>, or None """
+        ftype = node.find(".//file")
+        if ftype is None or 'size' not in ftype.attrib:
+            return None
+        try:
+            return int(ftype.attrib['size'])
+        except ValueError:
+            Abort("Error in cluster xml file. Size of disk image %s must be a number of bytes" %
+                node.find(".//disk/source").attrib.get('file'))
+
+    def addDigests(self, digests):
+        """ Add sha256 checksums from a dictionary {'file name': digest}
+            to the image files and parts that have none in the xml """
+        for vals in self.diskinfo.values():
+            for part in vals['parts']:
+                name = os.path.basename(part)
+                if part not in vals['digests'] and name in digests:
+                    vals['digests'][part] = digests[name]
+            if 'file' in vals and not vals['sha256']:
+                vals['sha256'] = digests.get(os.path.basename(vals['file']))
+
+    def getImageDigests(self):
+        """ Returns a dictionary of image file names and their sha256 checksums
+            for the files listed by getImageNames() that have one """
+        digests = {}
+        for key in self.diskinfo.keys():
+            vals = self.diskinfo[key]
+            if vals['parts']:
+                digests.update(vals['digests'])
+            elif 'file' in vals and vals['sha256']:
+                digests[vals['file']] = vals['sha256']
+        return digests
+
     def getDiskInfo(self):
         return self.diskinfo
     
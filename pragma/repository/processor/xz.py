@@ -0,0 +1,13 @@
+from pragma.repository.processor.command import CommandProcessor
+
+
+class Xz(CommandProcessor):
+    """
+    Xz Processor
+
+    Decompress xz files on all cores (multi-block files written by
+    xz -T, with xz 5.4 or newer)
+    """
+    COMMANDS = [
+        ["xz", "-d", "-c", "-q", "-T", "%(threads)d"],
+    ]
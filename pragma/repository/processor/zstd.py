@@ -0,0 +1,14 @@
+from pragma.repository.processor.command import CommandProcessor
+
+
+class Zstd(CommandProcessor):
+    """
+    Zstd Processor
+
+    Decompress zstd files. pzstd is used when installed, it decompresses
+    the independent frames of files compressed by pzstd on all cores
+    """
+    COMMANDS = [
+        ["pzstd", "-d", "-c", "-q", "-p", "%(threads)d"],
+        ["zstd", "-d", "-c", "-q"],
+    ]
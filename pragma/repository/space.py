@@ -0,0 +1,91 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+
+logger = logging.getLogger('pragma.repository.space')
+
+# fallocate(2) mode allocating blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+
+MB = 1024.0 * 1024.0
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    _fallocate = _libc.fallocate64
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def preallocate(f, length, offset=0):
+    """
+    Allocate length bytes at offset of the open file f (a file object or
+    descriptor) so the data is laid out contiguously, without changing
+    the file size. Raises OSError with ENOSPC if the filesystem is full.
+
+    :return: True if the blocks were allocated, False if not supported
+    """
+    if _fallocate is None or length <= 0:
+        return False
+    fd = f if isinstance(f, int) else f.fileno()
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err == errno.ENOSPC:
+        raise OSError(err, "%s, %d bytes can't be allocated" % (os.strerror(err), length))
+    return False
+
+
+def freeSpace(path):
+    """ returns bytes available to users on the filesystem of path """
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def allocated(path):
+    """ returns bytes allocated by the file path, 0 if it doesn't exist """
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return 0
+
+
+class SpacePlan(object):
+    """
+    Bytes a boot is about to add to a filesystem, with what needs them,
+    so it can fail before the first byte is written when they don't fit.
+    Sizes that can't be known up front are listed as unknown.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.items = []    # format [(description, bytes), ...]
+        self.unknown = []  # descriptions of items of unknown size
+
+    def add(self, description, size):
+        if size is None:
+            self.unknown.append(description)
+        elif size > 0:
+            self.items.append((description, size))
+
+    def needed(self):
+        return sum([size for description, size in self.items])
+
+    def check(self):
+        """ returns None if the plan fits, otherwise an error message """
+        needed = self.needed()
+        free = freeSpace(self.path)
+        if self.unknown:
+            logger.warning("Size of %s unknown, not counted in the space needed" % ", ".join(self.unknown))
+        logger.info("%.1f MB needed in %s, %.1f MB free" % (needed / MB, self.path, free / MB))
+        if needed <= free:
+            return None
+        msg = ["Not enough disk space in %s: %.1f MB needed, %.1f MB free" % (
+            self.path, needed / MB, free / MB)]
+        for description, size in self.items:
+            msg.append("  %s: %.1f MB" % (description, size / MB))
+        return "\n".join(msg)
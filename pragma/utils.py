@@ -7,6 +7,9 @@ import re
 import shlex
 import socket
 import struct
+import threading
+import time
+import Queue
 import xml.sax
 from xml.sax import handler
 from datetime import datetime
@@ -79,6 +82,81 @@ def which(program):
     return None
 
 
+def parallel_map(func, items, concurrency):
+	"""
+	Call func on each item using a bounded pool of worker threads.
+	Exceptions raised by func are collected instead of stopping the
+	remaining items.
+
+	:param func: Callable taking a single item as argument
+	:param items: List of hashable items to process
+	:param concurrency: Maximum number of worker threads to run
+
+	:return: A tuple (results, errors) of hash arrays where the key is the
+		item and the value is the return value or the raised exception
+	"""
+	results = {}
+	errors = {}
+	work = Queue.Queue()
+	for item in items:
+		work.put(item)
+	lock = threading.Lock()
+
+	def worker():
+		while True:
+			try:
+				item = work.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				result = func(item)
+				with lock:
+					results[item] = result
+			except Exception as e:
+				logger.error("Failed processing %s: %s" % (str(item), str(e)))
+				with lock:
+					errors[item] = e
+
+	nthreads = max(1, min(int(concurrency), len(items)))
+	threads = []
+	for i in range(nthreads):
+		t = threading.Thread(target=worker)
+		t.daemon = True
+		t.start()
+		threads.append(t)
+	for t in threads:
+		t.join()
+	return (results, errors)
+
+
+def wait_until(condition, timeout, description, interval=0.1, max_interval=5):
+	"""
+	Poll condition until it is true, starting every interval secs and
+	doubling the interval up to max_interval secs, so short waits end as
+	soon as the condition holds and long ones don't poll too often.
+
+	:param condition: Callable returning True once the wait is over
+	:param timeout: Maximum number of secs to wait
+	:param description: Text describing what is waited for in log messages
+	:param interval: Initial number of secs between checks
+	:param max_interval: Maximum number of secs between checks
+
+	:return: Number of secs waited or None if timeout was reached
+	"""
+	start = time.time()
+	while not condition():
+		elapsed = time.time() - start
+		if elapsed >= timeout:
+			logger.error("Timed out after %.1f secs waiting for %s" % (
+				elapsed, description))
+			return None
+		time.sleep(min(interval, timeout - elapsed))
+		interval = min(interval * 2, max_interval)
+	elapsed = time.time() - start
+	logger.info("Waited %.1f secs for %s" % (elapsed, description))
+	return elapsed
+
+
 def any(iterable):
     for element in iterable:
         if element:
@@ -0,0 +1,76 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pragma.drivers.kvm_rocks.distribute import ChainDistribution
+
+# runs the command on the local host the way ssh runs it on a remote one
+FAKE_SSH = """#!/bin/bash
+shift
+exec bash -c "$*"
+"""
+
+
+class ChainDistributionTest(unittest.TestCase):
+	HOSTS = 16
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		bindir = os.path.join(self.dir, "bin")
+		os.mkdir(bindir)
+		ssh = os.path.join(bindir, "ssh")
+		with open(ssh, "w") as f:
+			f.write(FAKE_SSH)
+		os.chmod(ssh, stat.S_IRWXU)
+		self.path = os.environ["PATH"]
+		os.environ["PATH"] = "%s:%s" % (bindir, self.path)
+
+		self.image = os.path.join(self.dir, "compute.img")
+		with open(self.image, "wb") as f:
+			f.write(os.urandom(256 * 1024))
+			f.truncate(4 * 1024 * 1024)
+		self.targets = []
+		for i in range(self.HOSTS):
+			# paths with spaces and quotes must survive every hop
+			disk_dir = os.path.join(self.dir, "vm container's disks %d" % i)
+			os.mkdir(disk_dir)
+			self.targets.append(("vm-container-0-%d" % i,
+				os.path.join(disk_dir, "compute-0-%d.vda" % i)))
+
+	def tearDown(self):
+		os.environ["PATH"] = self.path
+		shutil.rmtree(self.dir)
+
+	def test_command_length_is_linear(self):
+		distribution = ChainDistribution(self.image, self.targets)
+		chain = distribution.split()[0]
+		self.assertEqual(len(chain), self.HOSTS)
+		one = len(distribution.send_command(chain[:1])[-1])
+		per_hop = len(distribution.send_command(chain[:2])[-1]) - one
+		length = len(distribution.send_command(chain)[-1])
+		self.assertTrue(length <= one + per_hop * (self.HOSTS - 1) + 1024)
+		self.assertTrue(length < 16 * 1024)
+
+	def test_chain(self):
+		distribution = ChainDistribution(self.image, self.targets)
+		self.assertEqual(distribution.run(), [])
+		with open(self.image, "rb") as f:
+			data = f.read()
+		for host, dest in self.targets:
+			with open(dest, "rb") as f:
+				self.assertEqual(f.read(), data)
+
+	def test_failed_host(self):
+		targets = self.targets[:4]
+		targets[1] = (targets[1][0], os.path.join(self.dir, "missing", "disk.vda"))
+		distribution = ChainDistribution(self.image, targets, chains=2)
+		self.assertEqual(distribution.run(), [targets[1]])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,142 @@
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pragma.repository.downloader import Downloader, DownloadError, readahead
+
+DATA = "".join([chr(i % 251) for i in range(300 * 1024)])
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves DATA at /data with Range support, a redirect to it at /redirect
+    and 404 for anything else. Requests are recorded on the server with
+    the client port, so tests can tell which connection each one used.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(
+            (self.client_address[1], self.path, self.headers.getheader('range')))
+        if self.path == "/redirect":
+            self.reply(302, "", {'Location': "/data"})
+        elif self.path != "/data":
+            self.reply(404, "not found")
+        elif self.headers.getheader('range'):
+            start = int(self.headers.getheader('range').split("=")[1].split("-")[0])
+            self.reply(206, DATA[start:], {
+                'Content-Range': "bytes %d-%d/%d" % (start, len(DATA) - 1, len(DATA))})
+        else:
+            self.reply(200, DATA, {'Accept-Ranges': "bytes"})
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.downloader = Downloader(retries=0)
+
+    def tearDown(self):
+        self.downloader.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def read(self, name):
+        with open(os.path.join(self.dir, name), 'rb') as f:
+            return f.read()
+
+    def test_connection_reuse(self):
+        for name in ("a", "b", "c"):
+            self.downloader.fetch(self.url + "/data", os.path.join(self.dir, name))
+            self.assertEqual(self.read(name), DATA)
+        ports = [port for port, path, range in self.server.requests]
+        self.assertEqual(len(ports), 3)
+        self.assertEqual(len(set(ports)), 1)
+
+    def test_resume_partial(self):
+        path = os.path.join(self.dir, "data")
+        with open(path + Downloader.PARTIAL_SUFFIX, 'wb') as f:
+            f.write(DATA[:1000])
+        size = self.downloader.fetch(self.url + "/data", path,
+            hashlib.sha256(DATA).hexdigest())
+        self.assertEqual(size, len(DATA))
+        self.assertEqual(self.read("data"), DATA)
+        self.assertFalse(os.path.exists(path + Downloader.PARTIAL_SUFFIX))
+        self.assertEqual([(path, range) for port, path, range in self.server.requests],
+            [("/data", "bytes=1000-")])
+
+    def test_redirect(self):
+        self.downloader.fetch(self.url + "/redirect", os.path.join(self.dir, "data"))
+        self.assertEqual(self.read("data"), DATA)
+        self.assertEqual([path for port, path, range in self.server.requests],
+            ["/redirect", "/data"])
+
+    def test_error_status(self):
+        path = os.path.join(self.dir, "missing")
+        self.assertRaises(DownloadError, self.downloader.fetch,
+            self.url + "/missing", path)
+        self.assertFalse(os.path.exists(path))
+        # the error response was read, so its connection is reused
+        self.downloader.fetch(self.url + "/data", os.path.join(self.dir, "data"))
+        ports = [port for port, path, range in self.server.requests]
+        self.assertEqual(len(set(ports)), 1)
+
+
+class ReadaheadTest(unittest.TestCase):
+
+    def test_consumer_stops_early(self):
+        closed = threading.Event()
+
+        def chunks():
+            try:
+                while True:
+                    yield "x"
+            finally:
+                closed.set()
+
+        reader = readahead(chunks(), depth=2)
+        self.assertEqual(reader.next(), "x")
+        reader.close()
+        closed.wait(5)
+        self.assertTrue(closed.is_set())
+
+    def test_error(self):
+        def chunks():
+            yield "x"
+            raise IOError("interrupted")
+
+        self.assertRaises(IOError, list, readahead(chunks()))
+
+
+if __name__ == "__main__":
+    unittest.main()